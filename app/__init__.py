@@ -8,13 +8,17 @@ from werkzeug.exceptions import HTTPException
 
 from datetime import timedelta
 from threading import Thread
+from signal import signal, SIGTERM
+import sys
 
 from .routes import register_blueprints
-from .services.search import index_item
+from .commands import register_commands
+from .services.search import index_queued
 from .sockets import socketio
 # from .executors import *
 from .models import *
 from .models.base import BlobDependent
+from .models.file import SOURCE_WINDOW_LINES
 from .utils.daemons import *
 from .config import *
 
@@ -38,15 +42,18 @@ def context_processor():
         "FileMode":       FileMode,
         "FileVisibility": FileVisibility,
         "BlobType":       BlobType,
+        "SOURCE_WINDOW_LINES": SOURCE_WINDOW_LINES,
     }
 
 @app.before_request
 def before_request():
     session.permanent = True
     connect_all_dbs()
+    Blob.begin_identity_map()
 
 @app.teardown_request
 def teardown_request(_):
+    Blob.end_identity_map()
     close_all_dbs()
 
 @app.errorhandler(HTTPException)
@@ -58,17 +65,26 @@ def teardown_appcontext(_):
     close_all_dbs()
 
 register_blueprints(app)
+register_commands(app)
 
 def run_daemons():
-    Thread(target=search_indexing_daemon, args=(index_item, File, Pen),                daemon=True).start()
-    Thread(target=search_index_purger,    args=(SearchResult,),                        daemon=True).start()
+    Thread(target=search_index_worker,    args=(SearchIndexQueue, index_queued),       daemon=True).start()
+    Thread(target=search_index_purger,    args=(SearchResult, SearchDocument),         daemon=True).start()
     # Thread(target=process_pool_purger,    args=(PROCESS_POOL,),                        daemon=True).start()
     Thread(target=tmp_file_purger,        args=(TmpFile,),                             daemon=True).start()
     Thread(target=tmp_folder_purger,      args=(TmpFolder,),                           daemon=True).start()
     Thread(target=blob_purger,            args=(Blob, BlobDependent.__subclasses__()), daemon=True).start()
+    Thread(target=blob_compressor,        args=(Blob,),                                daemon=True).start()
+    Thread(target=blob_chunker,           args=(Blob,),                                daemon=True).start()
+    Thread(target=blob_variant_maker,     args=(Blob,),                                daemon=True).start()
+    Thread(target=highlight_warmer,       args=(Blob,),                                daemon=True).start()
+    Thread(target=highlight_evicter,      args=(Blob,),                                daemon=True).start()
+    Thread(target=counter_flusher,                                                     daemon=True).start()
 
 def run_app(debug=not PROD):
     run_daemons()
+    # exit normally on SIGTERM, so atexit flushes buffered view counts
+    signal(SIGTERM, lambda *_: sys.exit(0))
     socketio.run(
         app,
         host = SERVER_NAME.split(":")[0],
@@ -0,0 +1,93 @@
+import click
+
+from .models import Blob, Directory, SearchResult, SearchDocument
+from .models.base import BlobDependent
+from .services.search.index import rebuild_index
+from .services.search.benchmark import benchmark, SEARCH_BACKENDS
+from .config import BLOB_SHARD_DEPTH, BLOB_GC_GRACE_PERIOD, SEARCH_BACKEND, SEARCH_INDEX_WORKERS, SEARCH_INDEX_BATCH_SIZE
+
+
+@click.command("blob-migrate")
+@click.option("--depth", default=BLOB_SHARD_DEPTH, help="Fan-out levels of the target layout")
+def blob_migrate(depth):
+    """Move blob and variant files into the configured on-disk layout"""
+    def progress(moved):
+        if moved % 1000 == 0:
+            click.echo(f"moved {moved} files")
+    moved = Blob.migrate_layout(depth, progress)
+    click.echo(f"done, moved {moved} files")
+
+
+@click.command("blob-gc")
+@click.option("--dry-run", is_flag=True, help="Only report what would be deleted")
+@click.option("--grace-period", default=BLOB_GC_GRACE_PERIOD, help="Seconds an unreferenced blob is kept after last write")
+def blob_gc(dry_run, grace_period):
+    """Delete blobs no file, pen, revision or temp file refers to"""
+    result = Blob.purge(BlobDependent.__subclasses__(), grace_period, dry_run)
+    action = "would delete" if dry_run else "deleted"
+    click.echo(f"{action} {result['blobs']} blobs, {result['chunks']} chunks, {result['bytes']} bytes")
+
+
+@click.command("dir-rebuild")
+def dir_rebuild():
+    """Recompute directory aggregates from files"""
+    count = Directory.rebuild()
+    click.echo(f"rebuilt {count} directories")
+
+
+@click.command("search-rebuild")
+@click.option("--backend", default=SEARCH_BACKEND, type=click.Choice(SEARCH_BACKENDS), help="Search index to rebuild")
+@click.option("--workers", default=SEARCH_INDEX_WORKERS, help="Processes preparing documents, 0 for one per cpu")
+@click.option("--batch-size", default=SEARCH_INDEX_BATCH_SIZE, help="Documents written per transaction")
+def search_rebuild(backend, workers, batch_size):
+    """Index every file and pen again from scratch"""
+    last = [0]
+    def progress(indexed):
+        if indexed // 1000 > last[0] // 1000:
+            click.echo(f"indexed {indexed} items")
+        last[0] = indexed
+    indexed = rebuild_index(backend, progress, workers, batch_size)
+    click.echo(f"done, indexed {indexed} items")
+
+
+@click.command("search-purge")
+@click.option("--backend", default=SEARCH_BACKEND, type=click.Choice(SEARCH_BACKENDS), help="Search index to purge")
+@click.option("--chunk-size", default=500, help="Items deleted per transaction")
+def search_purge(backend, chunk_size):
+    """Delete search index rows of files and pens that no longer exist"""
+    def progress(purged):
+        click.echo(f"removed {purged['items']} items, {purged['rows']} rows")
+    index = SearchDocument if backend == "fts" else SearchResult
+    purged = index.purge(chunk_size, progress)
+    click.echo(f"done, removed {purged['items']} items, {purged['rows']} rows")
+
+
+@click.command("search-benchmark")
+@click.option("--documents", default=1000, help="Documents in synthetic corpus")
+@click.option("--queries", default=200, help="Searches run against each backend")
+@click.option("--seed", default=0, help="Seed of synthetic corpus and queries")
+def search_benchmark(documents, queries, seed):
+    """Compare search backends on a synthetic corpus in a scratch database"""
+    results = benchmark(documents, queries, seed)
+    click.echo(f"{'backend':<8} {'index s':>9} {'docs/s':>9} {'tokens/s':>10} {'size KiB':>9} {'mean ms':>9} {'p95 ms':>9}")
+    for backend, result in results.items():
+        click.echo(
+            f"{backend:<8} {result['index_time']:>9.2f} {result['docs_per_sec']:>9.0f} {result['tokens_per_sec']:>10.0f}"
+            f" {result['size'] // 1024:>9} {result['query_mean'] * 1000:>9.2f} {result['query_p95'] * 1000:>9.2f}"
+        )
+
+
+commands = [
+    blob_migrate,
+    blob_gc,
+    dir_rebuild,
+    search_rebuild,
+    search_purge,
+    search_benchmark,
+]
+
+def register_commands(app):
+    """Register CLI commands in `app`"""
+
+    for command in commands:
+        app.cli.add_command(command)
@@ -10,7 +10,21 @@ GIT_COMMAND_PATH = "git"
 DOCKER_COMMAND_PATH = "docker"
 GCC_COMMAND_PATH = "gcc"
 MAX_FILES_ON_HOME = 128
-SEARCH_INDEXING_TIME_DELAY = 3600
+SEARCH_QUEUE_POLL_INTERVAL = 60 # seconds
+SEARCH_INDEX_WORKERS = 0 # processes preparing documents on rebuild, 0 for one per cpu
+SEARCH_INDEX_BATCH_SIZE = 200 # documents written per transaction
+SEARCH_BACKEND = "fts" # "fts" or "table"
+BLOB_SHARD_DEPTH = 0
+BLOB_CACHE_LIMIT = 64 # MiB
+BLOB_COMPRESSION = False
+BLOB_GC_GRACE_PERIOD = 86400 # seconds
+BLOB_FSYNC = True
+BLOB_CHUNKING = False
+BLOB_CHUNKING_MIN_SIZE = 8 # MiB
+COUNTER_FLUSH_INTERVAL = 10 # seconds
+HIGHLIGHT_CACHE_LIMIT = 32 # MiB
+HIGHLIGHT_DISK_CACHE_LIMIT = 512 # MiB
+HIGHLIGHT_WHOLE_MAX_SIZE = 512 # KiB, larger sources are highlighted in windows of lines
 SERVER_NAME = "localhost:5000"
 SCHEME = "http"
 PROD = False
@@ -23,7 +37,21 @@ config_vars = [
     ("GCC_COMMAND_PATH", str),
     ("DOCKER_COMMAND_PATH", str),
     ("MAX_FILES_ON_HOME", int),
-    ("SEARCH_INDEXING_TIME_DELAY", int),
+    ("SEARCH_QUEUE_POLL_INTERVAL", int),
+    ("SEARCH_INDEX_WORKERS", int),
+    ("SEARCH_INDEX_BATCH_SIZE", int),
+    ("SEARCH_BACKEND", str),
+    ("BLOB_SHARD_DEPTH", int),
+    ("BLOB_CACHE_LIMIT", int),
+    ("BLOB_COMPRESSION", bool),
+    ("BLOB_GC_GRACE_PERIOD", int),
+    ("BLOB_FSYNC", bool),
+    ("BLOB_CHUNKING", bool),
+    ("BLOB_CHUNKING_MIN_SIZE", int),
+    ("COUNTER_FLUSH_INTERVAL", int),
+    ("HIGHLIGHT_CACHE_LIMIT", int),
+    ("HIGHLIGHT_DISK_CACHE_LIMIT", int),
+    ("HIGHLIGHT_WHOLE_MAX_SIZE", int),
     ("SERVER_NAME", str),
     ("SCHEME", str),
     ("PROD", bool),
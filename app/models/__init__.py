@@ -1,10 +1,10 @@
-from .blob         import Blob, BlobType, blob_db
+from .blob         import Blob, BlobCodec, BlobType, BlobVariant, blob_db
 from .comment      import Comment, comment_db
-from .file         import File, FileMode, FileType, FileVisibility, Dir, file_db
+from .file         import File, FileMode, FileType, FileVisibility, Dir, Directory, file_db
 from .notification import Notification, notification_db
 from .pen          import Pen, pen_db
 from .revision     import Revision, revision_db
-from .search       import SearchResult, SearchResultItemType, SearchIndexStatus, search_db
+from .search       import SearchResult, SearchDocument, SearchIndexQueue, SearchResultItemType, SearchIndexStatus, search_db
 from .shortlink    import ShortLink, shortlink_db
 from .tmpfile      import TmpFile, TmpFolder, tmpfile_db
 from .user         import User, user_db
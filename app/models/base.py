@@ -1,4 +1,5 @@
 from peewee import ModelBase, ModelSelect
+from playhouse.migrate import SqliteMigrator, migrate
 
 from abc import ABC, ABCMeta, abstractmethod
 from typing import Self, Iterable
@@ -18,9 +19,30 @@ class BlobDependent(ABC):
         """ Return iterable of all instance that depends on giving blob/hash """
         raise NotImplementedError
 
+    @classmethod
+    @abstractmethod
+    def referenced_blob_hashes(cls) -> Iterable[str]:
+        """ Return hashes of all blobs any instance depends on, in bulk """
+        raise NotImplementedError
+
     @property
     @abstractmethod
     def blob_dependencies(self) -> list[str]:
         """ Return Blob hashes this resource depends on """
         raise NotImplementedError
 
+
+
+def add_missing_columns(model) -> list[str]:
+    """ Add columns of `model` missing in its existing table, returns added field names """
+    database = model._meta.database
+    table = model._meta.table_name
+    columns = {column.name for column in database.get_columns(table)}
+    migrator = SqliteMigrator(database)
+    added = []
+    for field in model._meta.sorted_fields:
+        if field.column_name in columns:
+            continue
+        migrate(migrator.add_column(table, field.column_name, field))
+        added.append(field.name)
+    return added
@@ -1,9 +1,33 @@
-from peewee import SqliteDatabase, Model, CharField, IntegerField
+from peewee import SqliteDatabase, Model, CharField, IntegerField, TextField, chunked
+from pygments import highlight, __version__ as pygments_version
+from pygments.formatters import HtmlFormatter
+from pygments.lexer import Lexer
 
 from abc import abstractmethod
+from array import array
+from bisect import bisect_right
 from base64 import b64encode, b64decode
+from codecs import getincrementaldecoder
+from contextvars import ContextVar
+from gzip import GzipFile
+from io import BufferedReader, RawIOBase
+from itertools import accumulate
+from hashlib import sha256
+from queue import Queue
+from time import sleep, time
+from typing import BinaryIO, Callable, Iterable
+import zlib
+import os
 
-from ..utils import file_path, hash_sha256
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from .base import add_missing_columns
+from ..utils import file_path, hash_sha256, randstr, LRUCache, content_defined_chunks
+from ..config import BLOB_SHARD_DEPTH, BLOB_CACHE_LIMIT, BLOB_COMPRESSION, BLOB_GC_GRACE_PERIOD, BLOB_FSYNC
+from ..config import BLOB_CHUNKING, BLOB_CHUNKING_MIN_SIZE, HIGHLIGHT_CACHE_LIMIT, HIGHLIGHT_DISK_CACHE_LIMIT
 
 
 blob_db = SqliteDatabase(
@@ -13,6 +37,29 @@ blob_db = SqliteDatabase(
             "synchronous":  2,
             "busy_timeout": 8000,
         })
+blob_cache = LRUCache(BLOB_CACHE_LIMIT * 1024 * 1024) # contents by hash, blobs never change
+variant_queue = Queue()
+variant_requests = set()
+highlight_cache = LRUCache(HIGHLIGHT_CACHE_LIMIT * 1024 * 1024) # highlighted html by blob hash, lexer and options
+highlight_queue = Queue()
+highlight_requests = set()
+highlight_formatters = {False: HtmlFormatter(), True: HtmlFormatter(linenos=True)}
+identity_map: ContextVar[dict | None] = ContextVar("blob_identity_map", default=None) # blobs by hash of current request
+
+
+BLOB_CHUNK_SIZE = 64 * 1024 # bytes read and written at a time while streaming
+BLOB_SNIFF_SIZE = 8 * 1024  # prefix bytes used to detect text or binary
+BLOB_MAX_SHARD_DEPTH = 3    # deepest fan-out a blob can be looked up in
+BLOB_COMPRESSION_LEVEL = 6
+BLOB_COMPRESSION_MIN_SIZE = 1024 # smaller blobs are not worth compressing
+BLOB_COMPRESSION_MAX_RATIO = 0.9 # compressed size to size ratio worth keeping
+BLOB_CHUNK_SHARD_DEPTH = 2 # fan-out of chunk files, fixed as chunks outlive layout changes
+BLOB_VARIANT_SHARD_DEPTH = 2 # fan-out of variant files and their .skip markers, fixed as well
+BLOB_PREVIEW_LENGTH = 128 # characters of text kept as preview snippet
+BLOB_LOOKUP_BATCH_SIZE = 500 # hashes per IN query, below SQLite's variable limit
+HIGHLIGHT_SHARD_DEPTH = 2 # fan-out of highlighted html and line index files
+LINE_OFFSET_SIZE = 8 # bytes per entry of a line index file
+GZIP_SEEK_POINT_INTERVAL = 256 * 1024 # content bytes between full flushes of a gzip blob file, reading resumes at one
 
 
 class BlobType:
@@ -24,6 +71,294 @@ class BlobType:
     binary  = 2
 
 
+class BlobCodec:
+    """ Blob storage codec, how the blob file is stored on disk """
+    NONE    = 0
+    GZIP    = 1
+    CHUNKED = 2
+
+    none    = 0
+    gzip    = 1
+    chunked = 2
+
+    suffixes = {
+        0: "",
+        1: ".gz",
+        2: ".chunks",
+    }
+
+
+def sniff_type(head: bytes, final: bool = False) -> int:
+    """ Return BlobType of content starting with `head` """
+    try:
+        getincrementaldecoder("utf-8")().decode(head, final=final)
+    except UnicodeDecodeError:
+        return BlobType.BINARY
+    return BlobType.TEXT
+
+
+def new_compressor():
+    """ Return compressor producing gzip stream, for BlobCodec.GZIP """
+    return zlib.compressobj(BLOB_COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+class GzipSeekWriter:
+    """ Writes gzip stream of content to `file`, full flushing every GZIP_SEEK_POINT_INTERVAL content bytes """
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.compressor = new_compressor()
+        self.size = 0
+        # content offset and file offset of every full flush, decoding can start at either pair
+        self.points = array("Q")
+
+    def write(self, data: bytes):
+        data = memoryview(data)
+        while data:
+            part = data[:GZIP_SEEK_POINT_INTERVAL - self.size % GZIP_SEEK_POINT_INTERVAL]
+            self.file.write(self.compressor.compress(part))
+            self.size += len(part)
+            data = data[len(part):]
+            if self.size % GZIP_SEEK_POINT_INTERVAL == 0:
+                self.file.write(self.compressor.flush(zlib.Z_FULL_FLUSH))
+                self.points.extend((self.size, self.file.tell()))
+
+    def finish(self):
+        self.file.write(self.compressor.flush())
+
+
+class BlobVariant:
+    """ Content-Encoding a blob can be served pre-compressed in """
+    GZIP    = "gzip"
+    BROTLI  = "br"
+
+    gzip    = "gzip"
+    br      = "br"
+
+    suffixes = {
+        "gzip": ".gz",
+        "br":   ".br",
+    }
+
+    @staticmethod
+    def encodings() -> list[str]:
+        """ Return available encodings, most preferred first """
+        if brotli:
+            return [BlobVariant.BROTLI, BlobVariant.GZIP]
+        return [BlobVariant.GZIP]
+
+    @staticmethod
+    def new_compressor(encoding: str) -> tuple[Callable, Callable]:
+        """ Return compress and flush functions of a new compressor for `encoding` """
+        if encoding == BlobVariant.BROTLI:
+            compressor = brotli.Compressor()
+            return compressor.process, compressor.finish
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress, compressor.flush
+
+
+def shard_dirs(hash: str, depth: int = BLOB_SHARD_DEPTH) -> list[str]:
+    """ Return fan-out directory names of `hash` for a layout of `depth` levels """
+    depth = min(max(depth, 0), BLOB_MAX_SHARD_DEPTH)
+    return [hash[i*2:i*2+2] for i in range(depth)]
+
+
+def make_preview(head: bytes) -> str:
+    """ Return preview snippet of text content starting with `head` """
+    # utf-8 takes at most 4 bytes a character, a cut character is dropped
+    head = head[:BLOB_PREVIEW_LENGTH*4]
+    return getincrementaldecoder("utf-8")(errors="ignore").decode(head)[:BLOB_PREVIEW_LENGTH]
+
+
+def commit_file(file: BinaryIO, tmp_filepath: str, filepath: str):
+    """ Move finished temp file into place atomically, durable if BLOB_FSYNC is set """
+    file.flush()
+    if BLOB_FSYNC:
+        os.fsync(file.fileno())
+    file.close()
+    dirpath = os.path.dirname(filepath)
+    os.makedirs(dirpath, exist_ok=True)
+    os.replace(tmp_filepath, filepath)
+    if BLOB_FSYNC:
+        # make the rename itself survive a crash
+        dir_fd = os.open(dirpath, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def chunk_path_for(hash: str, codec: int = BlobCodec.NONE) -> str:
+    """ Return path of stored chunk file of `hash` """
+    return file_path("chunk", *shard_dirs(hash, BLOB_CHUNK_SHARD_DEPTH), hash + BlobCodec.suffixes[codec])
+
+
+def store_chunk(chunk: bytes, compress: bool = False) -> str:
+    """ Store `chunk` unless it already is, returns its hash """
+    hash = hash_sha256(chunk)
+    for codec in (BlobCodec.NONE, BlobCodec.GZIP):
+        filepath = chunk_path_for(hash, codec)
+        if os.path.exists(filepath):
+            os.utime(filepath) # restarts purge grace period of reused chunk
+            return hash
+
+    codec = BlobCodec.NONE
+    if compress:
+        compressor = new_compressor()
+        compressed = compressor.compress(chunk) + compressor.flush()
+        if len(compressed) <= len(chunk) * BLOB_COMPRESSION_MAX_RATIO:
+            chunk, codec = compressed, BlobCodec.GZIP
+
+    tmp_filepath = file_path("tmp", "chunk-" + randstr(16))
+    try:
+        with open(tmp_filepath, "wb") as file:
+            file.write(chunk)
+            commit_file(file, tmp_filepath, chunk_path_for(hash, codec))
+    finally:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+    return hash
+
+
+def read_manifest(filepath: str) -> list[tuple[str, int]]:
+    """ Return (hash, size) of chunks listed in manifest of a chunked blob """
+    with open(filepath) as file:
+        return [(hash, int(size)) for hash, size in map(str.split, file)]
+
+
+class ChunkedBlobReader(RawIOBase):
+    """ Stream reassembling content of a chunked blob from its chunk files """
+
+    def __init__(self, manifest_filepath: str):
+        manifest = read_manifest(manifest_filepath)
+        self.chunk_hashes = [hash for hash, _ in manifest]
+        self.chunk_offsets = list(accumulate((size for _, size in manifest), initial=0))
+        self.index = 0
+        self.position = 0
+        self.chunk_file = None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.chunk_offsets[-1]
+        offset = max(offset, 0)
+        if self.chunk_file:
+            self.chunk_file.close()
+            self.chunk_file = None
+        # only the chunk holding the offset is read up to it
+        self.index = bisect_right(self.chunk_offsets, offset) - 1
+        if self.index < len(self.chunk_hashes):
+            self.open_chunk()
+            self.chunk_file.seek(offset - self.chunk_offsets[self.index - 1])
+        self.position = offset
+        return offset
+
+    def open_chunk(self):
+        hash = self.chunk_hashes[self.index]
+        self.index += 1
+        filepath = chunk_path_for(hash)
+        if os.path.exists(filepath):
+            self.chunk_file = open(filepath, "rb")
+        else:
+            self.chunk_file = GzipFile(chunk_path_for(hash, BlobCodec.GZIP), "rb")
+
+    def readinto(self, buffer) -> int:
+        while True:
+            if self.chunk_file is None:
+                if self.index >= len(self.chunk_hashes):
+                    return 0
+                self.open_chunk()
+            n = self.chunk_file.readinto(buffer)
+            if n:
+                self.position += n
+                return n
+            self.chunk_file.close()
+            self.chunk_file = None
+
+    def close(self):
+        if self.chunk_file:
+            self.chunk_file.close()
+            self.chunk_file = None
+        super().close()
+
+
+def highlight_key(hash: str, lexer: Lexer, linenos: bool) -> str:
+    """ Return cache key of `hash` content highlighted by `lexer` """
+    lexer_name = lexer.aliases[0] if lexer.aliases else lexer.name
+    return f"{hash}.{lexer_name}.{int(linenos)}"
+
+
+def highlight_path_for(key: str) -> str:
+    """ Return path of highlighted html file of cache `key` """
+    # other pygments versions may render differently, their files age out by the disk budget
+    return file_path("highlight", pygments_version, *shard_dirs(key, HIGHLIGHT_SHARD_DEPTH), key + ".html")
+
+
+def line_index_path_for(hash: str) -> str:
+    """ Return path of line index file of blob `hash` """
+    return file_path("lineindex", *shard_dirs(hash, HIGHLIGHT_SHARD_DEPTH), hash + ".idx")
+
+
+def seek_points_path_for(hash: str) -> str:
+    """ Return path of gzip seek points file of blob `hash`, next to its line index """
+    return file_path("lineindex", *shard_dirs(hash, HIGHLIGHT_SHARD_DEPTH), hash + ".seek")
+
+
+def write_offsets(filepath: str, offsets: array):
+    """ Write array of offsets to `filepath` atomically """
+    if offsets.itemsize != LINE_OFFSET_SIZE:
+        raise RuntimeError("unsupported array item size")
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    tmp_filepath = file_path("tmp", "offsets-" + randstr(16))
+    try:
+        with open(tmp_filepath, "wb") as file:
+            offsets.tofile(file)
+        os.replace(tmp_filepath, filepath)
+    finally:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+
+
+def read_gzip_range(filepath: str, points_filepath: str, begin: int, end: int) -> bytes:
+    """ Return content bytes `begin` to `end` of gzip file, decoding from the last seek point before `begin` """
+    points = array("Q")
+    with open(points_filepath, "rb") as file:
+        points.frombytes(file.read())
+    index = bisect_right(points[0::2], begin) - 1
+    if index < 0:
+        with GzipFile(filepath, "rb") as file:
+            file.seek(begin)
+            return file.read(end - begin)
+    offset, file_offset = points[2*index], points[2*index+1]
+    # a full flush leaves no back references, raw deflate decodes from there on its own
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    content = bytearray()
+    with open(filepath, "rb") as file:
+        file.seek(file_offset)
+        while offset + len(content) < end and not decompressor.eof and (chunk := file.read(BLOB_CHUNK_SIZE)):
+            content += decompressor.decompress(chunk)
+    return bytes(content[begin-offset:end-offset])
+
+
+def open_blob_file(filepath: str, codec: int) -> BinaryIO:
+    """ Open stored blob file for reading decoded content """
+    if codec == BlobCodec.GZIP:
+        return GzipFile(filepath, "rb")
+    if codec == BlobCodec.CHUNKED:
+        return BufferedReader(ChunkedBlobReader(filepath), BLOB_CHUNK_SIZE)
+    return open(filepath, "rb")
+
+
 class BlobMeta(type(Model)):
     """ Blob Metaclass """
 
@@ -45,6 +380,8 @@ class Blob(Model, metaclass=BlobMeta):
     hash : str | CharField = CharField(64, primary_key = True)
     size : int | IntegerField = IntegerField()
     type : int | IntegerField = IntegerField()
+    codec : int | IntegerField = IntegerField(default=BlobCodec.NONE)
+    preview : str | TextField = TextField(null=True) # None until computed, for blobs stored before it
 
     def __repr__(self):
         return f"<Blob: {self.short_hash}>"
@@ -80,9 +417,228 @@ class Blob(Model, metaclass=BlobMeta):
     def __gt__(self, other):
         return self.size > other.size
 
+    @staticmethod
+    def path_for(hash: str, depth: int = BLOB_SHARD_DEPTH, codec: int = BlobCodec.NONE) -> str:
+        """ Return path of blob file for `hash` in a layout of `depth` fan-out levels """
+        return file_path("blob", *shard_dirs(hash, depth), hash + BlobCodec.suffixes[codec])
+
+    @classmethod
+    def migrate_layout(cls, depth: int = BLOB_SHARD_DEPTH, progress=None) -> int:
+        """ Move blob files into the layout of `depth` and variants into their fixed one, returns number of moved files """
+        # resumable and safe while serving, readers fall back to other layouts
+        moved = 0
+        for dirpath, _, filenames in os.walk(file_path("blob")):
+            for filename in filenames:
+                hash, suffix = filename[:64], filename[64:]
+                codecs = [c for c, s in BlobCodec.suffixes.items() if s == suffix]
+                if len(hash) != 64 or not codecs:
+                    continue
+                src = os.path.join(dirpath, filename)
+                dst = cls.path_for(hash, depth, codecs[0])
+                if src == dst:
+                    continue
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                os.replace(src, dst)
+                moved += 1
+                if progress:
+                    progress(moved)
+
+        # variants were placed by blob layout depth before getting a fixed one
+        for dirpath, _, filenames in os.walk(file_path("variant")):
+            for filename in filenames:
+                hash, suffix = filename[:64], filename[64:].removesuffix(".skip")
+                encodings = [e for e, s in BlobVariant.suffixes.items() if s == suffix]
+                if len(hash) != 64 or not encodings:
+                    continue
+                src = os.path.join(dirpath, filename)
+                dst = cls.variant_path_for(hash, encodings[0]) + filename[64 + len(suffix):]
+                if src == dst:
+                    continue
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                os.replace(src, dst)
+                moved += 1
+                if progress:
+                    progress(moved)
+        return moved
+
+    @classmethod
+    def uncompressed(cls, after: str = "", limit: int = 100):
+        """ Return text blobs stored without compression, ordered by hash """
+        return cls.select().where(
+                cls.codec == BlobCodec.NONE
+                ).where(
+                cls.type == BlobType.TEXT
+                ).where(
+                cls.hash > after
+                ).order_by(cls.hash).limit(limit)
+
+    @classmethod
+    def purge(cls, dependents: list, grace_period: int = BLOB_GC_GRACE_PERIOD, dry_run: bool = False) -> dict:
+        """ Delete blobs no dependent refers to, returns number of blobs and bytes reclaimed """
+        # mark, every hash any dependent refers to in one pass per table.
+        # 64 bit prefixes keep the set small, a collision only keeps a garbage blob
+        referenced = set()
+        for dependent in dependents:
+            referenced.update(int(hash[:16], 16) for hash in dependent.referenced_blob_hashes() if hash)
+
+        # sweep, collect candidates first and delete in batches, not while iterating
+        candidates = [
+            hash for hash, in cls.select(cls.hash).tuples().iterator()
+            if int(hash[:16], 16) not in referenced
+        ]
+        del referenced
+
+        # blobs written or reused within grace period may not be referenced yet
+        deadline = time() - grace_period
+        purged = reclaimed = 0
+        would_purge = set() # dry run keeps them, their chunks must still count as freed
+        for hashes in chunked(candidates, 500):
+            unreferenced = []
+            for blob in cls.select().where(cls.hash.in_(hashes)):
+                filepaths = blob.stored_files()
+                if filepaths and os.path.getmtime(filepaths[0]) > deadline:
+                    continue
+                # got referenced after marking
+                if any(dependent.get_blob_dependents(blob.hash).exists() for dependent in dependents):
+                    continue
+                unreferenced.append(blob)
+            if not unreferenced:
+                continue
+            purged += len(unreferenced)
+            if dry_run:
+                reclaimed += sum(os.path.getsize(filepath) for blob in unreferenced for filepath in blob.stored_files())
+                would_purge.update(blob.hash for blob in unreferenced)
+                continue
+            with blob_db.atomic():
+                cls.delete().where(cls.hash.in_([blob.hash for blob in unreferenced])).execute()
+            for blob in unreferenced:
+                reclaimed += blob.remove_files()
+
+        # chunks no remaining manifest lists, young ones may belong to a blob being chunked
+        referenced_chunks = set()
+        for blob in cls.select().where(cls.codec == BlobCodec.CHUNKED).iterator():
+            if blob.hash in would_purge:
+                continue
+            filepath, codec = blob.locate()
+            if codec == BlobCodec.CHUNKED:
+                referenced_chunks.update(hash for hash, _ in read_manifest(filepath))
+        purged_chunks = 0
+        for dirpath, _, filenames in os.walk(file_path("chunk")):
+            for filename in filenames:
+                if filename[:64] in referenced_chunks:
+                    continue
+                filepath = os.path.join(dirpath, filename)
+                if os.path.getmtime(filepath) > deadline:
+                    continue
+                purged_chunks += 1
+                reclaimed += os.path.getsize(filepath)
+                if not dry_run:
+                    os.remove(filepath)
+        return {"blobs": purged, "chunks": purged_chunks, "bytes": reclaimed}
+
+    @classmethod
+    def unchunked(cls, after: str = "", limit: int = 100):
+        """ Return blobs big enough to be chunked but stored whole, ordered by hash """
+        return cls.select().where(
+                cls.codec != BlobCodec.CHUNKED
+                ).where(
+                cls.size >= BLOB_CHUNKING_MIN_SIZE * 1024 * 1024
+                ).where(
+                cls.hash > after
+                ).order_by(cls.hash).limit(limit)
+
+    @staticmethod
+    def variant_path_for(hash: str, encoding: str) -> str:
+        """ Return path of pre-compressed variant file of blob `hash` """
+        return file_path("variant", *shard_dirs(hash, BLOB_VARIANT_SHARD_DEPTH), hash + BlobVariant.suffixes[encoding])
+
+    @staticmethod
+    def next_variant_request() -> tuple[str, str]:
+        """ Wait for and return next (hash, encoding) variant to be made """
+        request = variant_queue.get()
+        variant_requests.discard(request)
+        return request
+
+    @staticmethod
+    def request_highlight(hash: str, lexer: Lexer, linenos: bool = False):
+        """ Ask for highlighted html of blob `hash` to be rendered in the background """
+        key = highlight_key(hash, lexer, linenos)
+        if key not in highlight_requests:
+            highlight_requests.add(key)
+            highlight_queue.put((hash, lexer, linenos))
+
+    @staticmethod
+    def next_highlight_request() -> tuple[str, Lexer, bool]:
+        """ Wait for and return next (hash, lexer, linenos) highlight to be rendered """
+        request = highlight_queue.get()
+        highlight_requests.discard(highlight_key(*request))
+        return request
+
+    @staticmethod
+    def evict_highlights(limit: int = HIGHLIGHT_DISK_CACHE_LIMIT * 1024 * 1024) -> int:
+        """ Remove least recently used highlighted html files above `limit` bytes, returns bytes freed """
+        files = []
+        for dirpath, _, filenames in os.walk(file_path("highlight")):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(filepath)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, filepath))
+        total = sum(size for _, size, _ in files)
+        freed = 0
+        files.sort()
+        for _, size, filepath in files:
+            if total - freed <= limit:
+                break
+            try:
+                os.remove(filepath)
+                freed += size
+            except FileNotFoundError:
+                pass
+        return freed
+
+    @staticmethod
+    def cache_stats() -> dict:
+        """ Return hit, miss and eviction counters of the blob content cache """
+        return blob_cache.stats()
+
     @classmethod
     def by_hash(cls, hash: str) -> "Blob":
-        return cls.get_or_none(cls.hash == hash)
+        blobs = identity_map.get()
+        if blobs is not None and hash in blobs:
+            return blobs[hash]
+        blob = cls.get_or_none(cls.hash == hash)
+        if blobs is not None and blob:
+            blobs[hash] = blob
+        return blob
+
+    @classmethod
+    def by_hashes(cls, hashes: Iterable[str]) -> dict[str, "Blob"]:
+        """ Return blobs of `hashes` keyed by hash in one query, unknown hashes are left out """
+        blobs = identity_map.get()
+        hashes = set(hashes)
+        found = {}
+        if blobs is not None:
+            found = {hash: blobs[hash] for hash in hashes if hash in blobs}
+        missing = list(hashes - found.keys())
+        for i in range(0, len(missing), BLOB_LOOKUP_BATCH_SIZE):
+            for blob in cls.select().where(cls.hash.in_(missing[i:i+BLOB_LOOKUP_BATCH_SIZE])):
+                found[blob.hash] = blob
+        if blobs is not None:
+            blobs.update(found)
+        return found
+
+    @staticmethod
+    def begin_identity_map():
+        """ Start remembering looked up blobs, for the current request """
+        identity_map.set({})
+
+    @staticmethod
+    def end_identity_map():
+        """ Forget blobs remembered since `begin_identity_map` """
+        identity_map.set(None)
 
     @classmethod
     def from_base64(cls, data: str) -> "Blob":
@@ -95,8 +651,7 @@ class Blob(Model, metaclass=BlobMeta):
     @classmethod
     def from_file(cls, filepath: str) -> "Blob":
         with open(filepath, "rb") as file:
-            data = file.read()
-        return cls.create(data)
+            return cls.create_from_stream(file)
 
     @classmethod
     def from_str(cls, data: str) -> "Blob":
@@ -104,50 +659,415 @@ class Blob(Model, metaclass=BlobMeta):
 
     @classmethod
     def create(cls, content: str | bytes) -> "Blob":
+        if isinstance(content, str):
+            content = content.encode()
         hash = hash_sha256(content)
-        size = len(content)
-        filepath = file_path("blob", hash)
 
         if blob := cls.by_hash(hash):
+            blob.touch()
             return blob
 
-        if isinstance(content, bytes):
-            try:
-                content = content.decode()
-            except:
-                pass
-
-        if isinstance(content, bytes):
-            with open(filepath, "wb") as file:
-                file.write(content)
-            type = BlobType.BINARY
-        else:
-            with open(filepath, "wb") as file:
-                file.write(content.encode())
+        try:
+            content.decode()
             type = BlobType.TEXT
+        except UnicodeDecodeError:
+            type = BlobType.BINARY
 
-        blob = Blob(
-            hash = hash,
-            size = size,
-            type = type
-        )
+        codec = BlobCodec.NONE
+        if BLOB_COMPRESSION and type == BlobType.TEXT and len(content) >= BLOB_COMPRESSION_MIN_SIZE:
+            codec = BlobCodec.GZIP
+
+        return cls.ingest([content], type, codec, expected_hash=hash) or Blob()
+
+    @classmethod
+    def create_from_stream(cls, stream: BinaryIO) -> "Blob":
+        """ Create blob from file-like object, one chunk in memory at a time """
+        def read(size: int) -> bytes:
+            chunk = stream.read(size)
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            return chunk
+
+        head = b""
+        while len(head) < BLOB_SNIFF_SIZE and (chunk := read(BLOB_SNIFF_SIZE-len(head))):
+            head += chunk
+        # whole content got sniffed, a truncated trailing character makes it binary
+        type = sniff_type(head, final=len(head) < BLOB_SNIFF_SIZE)
+
+        codec = BlobCodec.NONE
+        if BLOB_COMPRESSION and type == BlobType.TEXT and len(head) >= BLOB_COMPRESSION_MIN_SIZE:
+            codec = BlobCodec.GZIP
+
+        def chunks():
+            chunk = head
+            while chunk:
+                yield chunk
+                chunk = read(BLOB_CHUNK_SIZE)
+
+        return cls.ingest(chunks(), type, codec)
+
+    @classmethod
+    def ingest(cls, chunks: Iterable[bytes], type: int, codec: int, expected_hash: str | None = None) -> "Blob | None":
+        """ Store `chunks` as a blob, hashing while writing, returns None if content is not `expected_hash` """
+        hasher = sha256()
+        size = 0
+        head = b""
+        # unique temp file, concurrent writers of same content never share a file
+        tmp_filepath = file_path("tmp", "blob-" + randstr(16))
+
+        try:
+            with open(tmp_filepath, "wb") as file:
+                writer = GzipSeekWriter(file) if codec == BlobCodec.GZIP else file
+                for chunk in chunks:
+                    hasher.update(chunk)
+                    size += len(chunk)
+                    if len(head) < BLOB_PREVIEW_LENGTH * 4:
+                        head += chunk[:BLOB_PREVIEW_LENGTH*4]
+                    writer.write(chunk)
+                if codec == BlobCodec.GZIP:
+                    writer.finish()
+
+                hash = hasher.hexdigest()
+                if expected_hash and hash != expected_hash:
+                    return None
+                if blob := cls.by_hash(hash):
+                    blob.touch()
+                    return blob
 
-        if not blob.verify():
-            return Blob()
+                filepath = cls.path_for(hash, codec=codec)
+                commit_file(file, tmp_filepath, filepath)
+        finally:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
 
-        blob = super().create(
+        # lost a race to a writer of same content, its row wins
+        cls.insert(
             hash = hash,
             size = size,
-            type = type
-        )
+            type = type,
+            codec = codec,
+            preview = make_preview(head) if type == BlobType.TEXT else ""
+        ).on_conflict_ignore().execute()
+        blob = cls.by_hash(hash)
+        if blob.codec != codec:
+            os.remove(filepath)
+        elif codec == BlobCodec.GZIP and writer.points:
+            write_offsets(seek_points_path_for(hash), writer.points)
         return blob
 
+    def locate(self) -> tuple[str, int]:
+        """ Return path and codec of the stored blob file """
+        codecs = [self.codec] + [c for c in BlobCodec.suffixes if c != self.codec]
+        # not migrated to the configured layout or recompressed since the lookup
+        for depth in [BLOB_SHARD_DEPTH] + list(range(BLOB_MAX_SHARD_DEPTH+1)):
+            for codec in codecs:
+                filepath = self.path_for(self.hash, depth, codec)
+                if os.path.exists(filepath):
+                    return filepath, codec
+        return self.path_for(self.hash, codec=self.codec), self.codec
+
+    def compress(self) -> bool:
+        """ Rewrite stored blob file compressed, returns True if it got compressed """
+        if self.codec != BlobCodec.NONE or self.type != BlobType.TEXT:
+            return False
+        if BLOB_CHUNKING and self.size >= BLOB_CHUNKING_MIN_SIZE * 1024 * 1024:
+            return False # left for chunking, chunks get compressed there
+
+        tmp_filepath = file_path("tmp", "blob-" + randstr(16))
+        try:
+            old_filepath, _ = self.locate()
+            with self.open() as src, open(tmp_filepath, "wb") as dst:
+                writer = GzipSeekWriter(dst)
+                while chunk := src.read(BLOB_CHUNK_SIZE):
+                    writer.write(chunk)
+                writer.finish()
+                if dst.tell() > self.size * BLOB_COMPRESSION_MAX_RATIO:
+                    return False
+                filepath = self.path_for(self.hash, codec=BlobCodec.GZIP)
+                commit_file(dst, tmp_filepath, filepath)
+            if writer.points:
+                write_offsets(seek_points_path_for(self.hash), writer.points)
+            Blob.update(codec=BlobCodec.GZIP).where(Blob.hash == self.hash).execute()
+            self.codec = BlobCodec.GZIP
+            os.remove(old_filepath)
+        finally:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+        return True
+
+    def chunk(self) -> bool:
+        """ Rewrite stored blob as manifest of content-defined chunks, returns True if it got chunked """
+        if self.codec == BlobCodec.CHUNKED:
+            return False
+
+        tmp_filepath = file_path("tmp", "blob-" + randstr(16))
+        try:
+            old_filepath, _ = self.locate()
+            with self.open() as src, open(tmp_filepath, "w") as manifest:
+                # similar versions share most chunks, only changed ones get stored
+                for chunk in content_defined_chunks(src):
+                    hash = store_chunk(chunk, compress=self.type == BlobType.TEXT)
+                    manifest.write(f"{hash} {len(chunk)}\n")
+                    sleep(0) # let others run while chunking large blobs
+                filepath = self.path_for(self.hash, codec=BlobCodec.CHUNKED)
+                commit_file(manifest, tmp_filepath, filepath)
+            Blob.update(codec=BlobCodec.CHUNKED).where(Blob.hash == self.hash).execute()
+            self.codec = BlobCodec.CHUNKED
+            os.remove(old_filepath)
+        finally:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+        return True
+
+    def get_variant(self, encoding: str) -> str | None:
+        """ Return path of pre-compressed variant file, requests it if not made yet """
+        if self.size < BLOB_COMPRESSION_MIN_SIZE:
+            return None
+        if encoding == BlobVariant.GZIP:
+            filepath, codec = self.locate()
+            if codec == BlobCodec.GZIP:
+                return filepath
+        filepath = self.variant_path_for(self.hash, encoding)
+        if os.path.exists(filepath):
+            return filepath
+        if os.path.exists(filepath + ".skip"):
+            return None
+        request = (self.hash, encoding)
+        if request not in variant_requests:
+            variant_requests.add(request)
+            variant_queue.put(request)
+        return None
+
+    def make_variant(self, encoding: str) -> bool:
+        """ Make pre-compressed variant file, returns True if it is worth serving """
+        filepath = self.variant_path_for(self.hash, encoding)
+        if os.path.exists(filepath) or os.path.exists(filepath + ".skip"):
+            return os.path.exists(filepath)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+        tmp_filepath = file_path("tmp", "variant-" + randstr(16))
+        try:
+            with self.open() as src, open(tmp_filepath, "wb") as dst:
+                compress, flush = BlobVariant.new_compressor(encoding)
+                chunk = src.read(BLOB_CHUNK_SIZE)
+                # already compressed media, no need to go through all of it
+                probe = len(zlib.compress(chunk, 1))
+                worth = probe <= len(chunk) * BLOB_COMPRESSION_MAX_RATIO
+                while worth and chunk:
+                    dst.write(compress(chunk))
+                    chunk = src.read(BLOB_CHUNK_SIZE)
+                    sleep(0) # let others run while compressing large blobs
+                if worth:
+                    dst.write(flush())
+                    worth = dst.tell() <= self.size * BLOB_COMPRESSION_MAX_RATIO
+            if worth:
+                os.replace(tmp_filepath, filepath)
+            else:
+                open(filepath + ".skip", "wb").close()
+        finally:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+        return worth
+
+    def highlighted_html(self, lexer: Lexer, linenos: bool = False) -> str:
+        """ Return text content highlighted by `lexer`, cached in memory and on disk """
+        key = highlight_key(self.hash, lexer, linenos)
+        html = highlight_cache.get(key)
+        if html is not None:
+            return html
+        filepath = highlight_path_for(key)
+        try:
+            with open(filepath, encoding="utf-8") as file:
+                html = file.read()
+            os.utime(filepath) # mtime orders disk eviction
+        except FileNotFoundError:
+            html = self.make_highlight(lexer, linenos)
+        highlight_cache.set(key, html)
+        return html
+
+    def make_highlight(self, lexer: Lexer, linenos: bool = False) -> str:
+        """ Render highlighted html of text content and store it on disk """
+        filepath = highlight_path_for(highlight_key(self.hash, lexer, linenos))
+        html = highlight(self.get_text(), lexer, highlight_formatters[bool(linenos)])
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        tmp_filepath = file_path("tmp", "highlight-" + randstr(16))
+        try:
+            with open(tmp_filepath, "w", encoding="utf-8") as file:
+                file.write(html)
+            os.replace(tmp_filepath, filepath)
+        finally:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+        return html
+
+    def warm_highlight(self, lexer: Lexer, linenos: bool = False) -> bool:
+        """ Render highlighted html to disk unless it is already there, returns True if rendered """
+        if self.type != BlobType.TEXT:
+            return False
+        if os.path.exists(highlight_path_for(highlight_key(self.hash, lexer, linenos))):
+            return False
+        self.make_highlight(lexer, linenos)
+        return True
+
+    def make_line_index(self) -> str:
+        """ Write offsets of every line start and the content end to line index file, returns its path """
+        filepath = line_index_path_for(self.hash)
+        # gzip stored before seek points were recorded, windows of it would decode from the start
+        self.add_seek_points()
+        offsets = array("Q", [0])
+        offset = 0
+        with self.open() as file:
+            while chunk := file.read(BLOB_CHUNK_SIZE):
+                position = chunk.find(b"\n")
+                while position != -1:
+                    offsets.append(offset + position + 1)
+                    position = chunk.find(b"\n", position + 1)
+                offset += len(chunk)
+                sleep(0) # let others run while indexing large blobs
+        # trailing newline ends the last line instead of starting an empty one
+        if len(offsets) > 1 and offsets[-1] == offset:
+            offsets.pop()
+        offsets.append(offset)
+        write_offsets(filepath, offsets)
+        return filepath
+
+    def line_offsets(self, start: int, count: int) -> list[int]:
+        """ Return offsets of lines `start` to `start + count` and of the end of last one, O(1) through line index """
+        filepath = line_index_path_for(self.hash)
+        if not os.path.exists(filepath):
+            filepath = self.make_line_index()
+        offsets = array("Q")
+        with open(filepath, "rb") as file:
+            file.seek(start * LINE_OFFSET_SIZE)
+            offsets.frombytes(file.read((count + 1) * LINE_OFFSET_SIZE))
+        return offsets.tolist()
+
+    def line_count(self) -> int:
+        """ Return number of lines of text content """
+        filepath = line_index_path_for(self.hash)
+        if not os.path.exists(filepath):
+            filepath = self.make_line_index()
+        return os.path.getsize(filepath) // LINE_OFFSET_SIZE - 1
+
+    def read_lines(self, start: int, count: int) -> bytes:
+        """ Return `count` lines of content starting at line `start`, counting from 0 """
+        offsets = self.line_offsets(max(start, 0), max(count, 0))
+        if len(offsets) < 2:
+            return b""
+        begin, end = offsets[0], offsets[-1]
+        content = blob_cache.get(self.hash)
+        if content is not None:
+            return content[begin:end]
+        filepath, codec = self.locate()
+        points_filepath = seek_points_path_for(self.hash)
+        if codec == BlobCodec.GZIP and os.path.exists(points_filepath):
+            return read_gzip_range(filepath, points_filepath, begin, end)
+        with self.open() as file:
+            # chunked files only decode within the chunk holding the offset
+            file.seek(begin)
+            return file.read(end - begin)
+
+    def add_seek_points(self) -> bool:
+        """ Rewrite gzip blob file stored without seek points, returns True if it got rewritten """
+        filepath, codec = self.locate()
+        if codec != BlobCodec.GZIP or self.size <= GZIP_SEEK_POINT_INTERVAL:
+            return False
+        if os.path.exists(seek_points_path_for(self.hash)):
+            return False
+
+        tmp_filepath = file_path("tmp", "blob-" + randstr(16))
+        try:
+            with GzipFile(filepath, "rb") as src, open(tmp_filepath, "wb") as dst:
+                writer = GzipSeekWriter(dst)
+                while chunk := src.read(BLOB_CHUNK_SIZE):
+                    writer.write(chunk)
+                    sleep(0) # let others run while compressing large blobs
+                writer.finish()
+                commit_file(dst, tmp_filepath, filepath)
+            # only once the file they point into is in place
+            write_offsets(seek_points_path_for(self.hash), writer.points)
+        finally:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+        return True
+
+    def highlighted_lines_html(self, lexer: Lexer, start: int, count: int) -> str:
+        """ Return `count` lines starting at line `start` highlighted by `lexer`, numbered from `start + 1` """
+        key = highlight_key(self.hash, lexer, True) + f".{start}.{count}"
+        html = highlight_cache.get(key)
+        if html is not None:
+            return html
+        # a window starting inside a multiline token is lexed without its beginning
+        text = self.read_lines(start, count).decode(errors="replace")
+        html = highlight(text, lexer, HtmlFormatter(linenos=True, linenostart=start + 1))
+        highlight_cache.set(key, html)
+        return html
+
+    def highlight_files(self) -> list[str]:
+        """ Return existing paths of highlighted html files of this blob """
+        dirpath = os.path.dirname(highlight_path_for(self.hash))
+        try:
+            filenames = os.listdir(dirpath)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(dirpath, filename) for filename in filenames if filename.startswith(self.hash + ".")]
+
+    def stored_files(self) -> list[str]:
+        """ Return existing paths of stored blob file and files derived from it, blob file first """
+        filepaths = [self.filepath]
+        for encoding in BlobVariant.suffixes:
+            filepath = self.variant_path_for(self.hash, encoding)
+            filepaths += [filepath, filepath + ".skip"]
+        filepaths += [line_index_path_for(self.hash), seek_points_path_for(self.hash)]
+        return [filepath for filepath in filepaths if os.path.exists(filepath)] + self.highlight_files()
+
+    def remove_files(self) -> int:
+        """ Remove stored blob file and its variants, returns bytes freed """
+        freed = 0
+        for filepath in self.stored_files():
+            try:
+                size = os.path.getsize(filepath)
+                os.remove(filepath)
+                freed += size
+            except FileNotFoundError:
+                pass
+        return freed
+
+    def touch(self):
+        """ Refresh mtime of stored blob file, restarts its purge grace period """
+        try:
+            os.utime(self.filepath)
+        except FileNotFoundError:
+            pass
+
+    def open(self) -> BinaryIO:
+        """ Open blob file for reading decoded content """
+        try:
+            return open_blob_file(*self.locate())
+        except FileNotFoundError:
+            # moved by a layout migration or recompressed after the lookup, look again
+            return open_blob_file(*self.locate())
+
     def get_bytes(self) -> bytes:
-        file = open(self.filepath, "rb")
-        content = file.read()
-        file.close()
+        content = blob_cache.get(self.hash)
+        if content is None:
+            with self.open() as file:
+                content = file.read()
+            blob_cache.set(self.hash, content)
         return content
 
+    def get_preview(self) -> str:
+        """ Return preview snippet of text content, empty for binary """
+        if self.preview is None:
+            # stored before previews, compute from a bounded read once
+            content = blob_cache.get(self.hash)
+            if content is None:
+                with self.open() as file:
+                    content = file.read(BLOB_PREVIEW_LENGTH * 4)
+            self.preview = make_preview(content) if self.type == BlobType.TEXT else ""
+            Blob.update(preview=self.preview).where(Blob.hash == self.hash).execute()
+        return self.preview
+
     def get_str(self) -> str:
         content = self.get_bytes()
         try:
@@ -172,7 +1092,7 @@ class Blob(Model, metaclass=BlobMeta):
         return b64encode(self.get_binary()).decode()
 
     def verify(self) -> bool:
-        with open(self.filepath, "rb") as file:
+        with self.open() as file:
             content = file.read()
             content_hash = hash_sha256(content)
         return content_hash == self.hash
@@ -196,7 +1116,8 @@ class Blob(Model, metaclass=BlobMeta):
 
     @property
     def filepath(self) -> str:
-        return file_path("blob", self.hash)
+        filepath, _ = self.locate()
+        return filepath
 
     @property
     def short_hash(self) -> str:
@@ -226,3 +1147,4 @@ class Blob(Model, metaclass=BlobMeta):
 
 
 blob_db.create_tables([Blob])
+add_missing_columns(Blob)
@@ -1,16 +1,21 @@
-from peewee import Model, SqliteDatabase, AutoField, CharField, IntegerField, BooleanField, TimestampField
-from pygments import lexers, highlight
-from pygments.formatters import HtmlFormatter
+from peewee import Model, SqliteDatabase, AutoField, CharField, IntegerField, BooleanField, TimestampField, fn, chunked
+from pygments import lexers
+from pygments.lexer import Lexer
+from pygments.util import ClassNotFound
 
 from typing import List, Union
 from datetime import datetime, UTC
 from mimetypes import guess_type
-from random import randint
+import mimetypes
+from fnmatch import translate
+from re import compile as re_compile
+from random import randint, shuffle
 
-from .blob import Blob
-from .base import PeeweeABCMeta, BlobDependent
+from .blob import Blob, BlobType
+from .base import PeeweeABCMeta, BlobDependent, add_missing_columns
 from ..utils.helpers import randstr
-from ..config import SCHEME, SERVER_NAME
+from ..utils.counters import WriteBehindCounter, WriteBehindCounted
+from ..config import SCHEME, SERVER_NAME, HIGHLIGHT_WHOLE_MAX_SIZE
 
 
 file_db = SqliteDatabase(
@@ -21,8 +26,9 @@ file_db = SqliteDatabase(
             "busy_timeout": 8000,
         })
 text_lexer = lexers.get_lexer_by_name("text")
-html_formatter = HtmlFormatter()
-html_formatter_with_linenos = HtmlFormatter(linenos=True)
+SOURCE_WINDOW_LINES = 1000   # lines per window of windowed source view
+RANDOM_SAMPLE_ROUNDS = 4      # id draws before falling back to ordering matching files randomly
+RANDOM_SAMPLE_MAX_DRAW = 500  # ids per draw, below SQLite's variable limit
 
 
 class FileMode:
@@ -101,16 +107,105 @@ class FileType:
         except:
             pass
 
+    # (lexer, mime, file type) by extension key, filled on first use of each key
+    extension_table: dict[str, tuple[Lexer, str, int]] = {}
+    # lexer filename patterns by shape, built once by load_name_patterns
+    exact_names: set[str] | None = None
+    wildcard_name_pattern = None
+    suffix_pattern = None
+    compound_suffix_pattern = None
+
+    @staticmethod
+    def load_name_patterns():
+        """Sort filename patterns of every lexer into exact names, wildcard names, suffixes and compound suffixes"""
+        if not mimetypes.inited:
+            mimetypes.init()
+        names, wildcards, suffixes, compounds = set(), [], [], []
+        for _, _, filenames, _ in lexers.get_all_lexers(plugins=True):
+            for pattern in filenames:
+                if pattern.startswith("*."):
+                    # matched against the suffix alone, without leading wildcard
+                    (compounds if "." in pattern[2:] else suffixes).append(translate(pattern[1:]))
+                elif any(char in pattern for char in "*?["):
+                    wildcards.append(translate(pattern))
+                else:
+                    names.add(pattern)
+        FileType.wildcard_name_pattern = re_compile("|".join(wildcards) or "(?!)")
+        FileType.suffix_pattern = re_compile("|".join(suffixes) or "(?!)")
+        FileType.compound_suffix_pattern = re_compile("|".join(compounds) or "(?!)")
+        FileType.exact_names = names
+
+    @staticmethod
+    def known_suffix(suffix: str) -> bool:
+        """Return True if some lexer or mime type is registered for `suffix` like ".py" """
+        lower = suffix.lower()
+        return bool(
+            FileType.suffix_pattern.match(suffix)
+            or lower in mimetypes.types_map or lower in mimetypes.encodings_map or lower in mimetypes.suffix_map
+            or suffix[1:] in FileType.ext_map
+        )
+
+    @staticmethod
+    def extension_key(filename: str) -> str | None:
+        """Return part of `filename` its lexer, mime and type depend on, None if it is not worth memoizing"""
+        if FileType.exact_names is None:
+            FileType.load_name_patterns()
+        # keys come from a bounded set, arbitrary names must not each get an entry
+        if filename in FileType.exact_names:
+            # names can not contain "/", keeps .bashrc apart from suffix .bashrc
+            return "/" + filename
+        if FileType.wildcard_name_pattern.match(filename):
+            # like Makefile.* or Kconfig*, depends on whole name
+            return None
+        dot = filename.rfind(".")
+        if dot == -1:
+            # lookup falls back to ext_map on the whole name, like gz or json
+            return None if filename in FileType.ext_map else ""
+        if dot == 0:
+            return None
+        suffix = filename[dot:]
+        previous = filename.rfind(".", 0, dot)
+        if previous > 0:
+            compound = filename[previous:]
+            if FileType.compound_suffix_pattern.match(compound):
+                return compound
+            # compressed, like .tar.gz, mime comes from the inner extension
+            if suffix.lower() in mimetypes.encodings_map and filename[previous:dot].lower() in mimetypes.types_map:
+                return compound
+        if suffix in FileType.extension_table or FileType.known_suffix(suffix):
+            return suffix
+        return None
+
+    @staticmethod
+    def lookup(name: str) -> tuple[Lexer, str, int]:
+        """Return (lexer, mime, file type) of `name`, not memoized"""
+        try:
+            lexer = lexers.get_lexer_for_filename(name)
+        except ClassNotFound:
+            lexer = text_lexer
+        mime = str(guess_type(name)[0])
+        if mime == "None":
+            mime = FileType.ext_map.get(name.split(".")[-1]) or "unknown/unknown"
+        file_type = FileType.type_map.get(mime.split("/")[0], 0)
+        return lexer, mime, file_type
+
+    @staticmethod
+    def resolve(filename: str) -> tuple[Lexer, str, int]:
+        """Return (lexer, mime, file type) of `filename`, memoized by extension key"""
+        key = FileType.extension_key(filename)
+        if key is None:
+            return FileType.lookup(filename)
+        resolved = FileType.extension_table.get(key)
+        if resolved is not None:
+            return resolved
+        # names sharing a key only differ in the stem, any of them resolves the same
+        name = key[1:] if key.startswith("/") else "file" + key
+        resolved = FileType.extension_table[key] = FileType.lookup(name)
+        return resolved
+
     @staticmethod
     def mimetype(filename: str) -> str:
-        mime = str(guess_type(filename)[0])
-        if mime != "None":
-            return mime
-        ext = filename.split(".")[-1]
-        mime = FileType.ext_map.get(ext)
-        if mime:
-            return mime
-        return "unknown/unknown"
+        return FileType.resolve(filename)[1]
 
     @staticmethod
     def mime_type(filename: str) -> str:
@@ -124,11 +219,14 @@ class FileType:
     
     @staticmethod
     def filetype(filename: str) -> int:
-        type = FileType.mime_type(filename)
-        return FileType.type_map.get(type, 0)
+        return FileType.resolve(filename)[2]
+
+    @staticmethod
+    def lexer(filename: str) -> Lexer:
+        return FileType.resolve(filename)[0]
 
 
-class File(Model, BlobDependent, metaclass=PeeweeABCMeta):
+class File(WriteBehindCounted, Model, BlobDependent, metaclass=PeeweeABCMeta):
     """ File """
 
     class Meta:
@@ -138,6 +236,10 @@ class File(Model, BlobDependent, metaclass=PeeweeABCMeta):
     user_id : int | IntegerField = IntegerField(null=True)
     title : str | CharField = CharField(max_length=255, default="")
     path : str | CharField = CharField(max_length=4096, unique=True)
+    dir_path : str | CharField = CharField(max_length=4096, default="", index=True)
+    size : int | IntegerField = IntegerField(default=0)
+    mime : str | CharField = CharField(max_length=255, default="unknown/unknown")
+    file_type : int | IntegerField = IntegerField(default=FileType.UNKNOWN)
     views : int | IntegerField = IntegerField(default=0)
     blob_hash : str | CharField = CharField(64)
     mode : int | IntegerField = IntegerField(default=FileMode.RENDER)
@@ -147,6 +249,57 @@ class File(Model, BlobDependent, metaclass=PeeweeABCMeta):
     modified : datetime | TimestampField = TimestampField(default=datetime.now(UTC))
 
     __unlocked : bool = False
+    __user : "User | None" = None
+    __comments_count : int | None = None
+
+    def save(self, force_insert: bool = False, only: list | None = None):
+        self.dir_path = self.dir_path_of(self.path)
+        with file_db.atomic():
+            old = None
+            if self.id is not None:
+                old = File.select(File.path, File.blob_hash, File.size, File.modified).where(File.id == self.id).tuples().first()
+            if old is None or old[0] != self.path:
+                self.mime = FileType.mimetype(self.name)
+                self.file_type = FileType.filetype(self.name)
+            if old is None or old[1] != self.blob_hash:
+                blob = self.blob
+                self.size = blob.size if blob else 0
+            saved = super().save(force_insert, only)
+            if old is None or old[0] != self.path or old[1] != self.blob_hash:
+                if self.size and not self.windowed_source and self.blob.type == BlobType.TEXT:
+                    Blob.request_highlight(self.blob_hash, self.lexer, linenos=True)
+            if old is None:
+                Directory.add_file(self.path, self.size, self.modified)
+            elif old[0] != self.path or old[1] != self.blob_hash:
+                Directory.remove_file(old[0], old[2])
+                Directory.add_file(self.path, self.size, self.modified)
+            elif File.modified.db_value(old[3]) != File.modified.db_value(self.modified):
+                Directory.touch(self.path, self.modified)
+        self.queue_for_indexing()
+        return saved
+
+    def delete_instance(self, *args, **kwargs):
+        with file_db.atomic():
+            deleted = super().delete_instance(*args, **kwargs)
+            if deleted:
+                Directory.remove_file(self.path, self.size)
+        if deleted:
+            self.queue_for_indexing()
+        return deleted
+
+    def queue_for_indexing(self) -> bool:
+        """Queue file for search indexing, returns False inside an outer transaction, its owner queues after commit"""
+        from .search import SearchIndexQueue
+        # index worker reads with its own connection, it would see the entry before this row
+        if file_db.in_transaction():
+            return False
+        SearchIndexQueue.push_item(self)
+        return True
+
+    @staticmethod
+    def dir_path_of(path: str) -> str:
+        """Return path of directory containing `path`, with trailing slash"""
+        return path[:path.rfind("/")+1]
 
     @staticmethod
     def username_from_path(path) -> str:
@@ -187,12 +340,60 @@ class File(Model, BlobDependent, metaclass=PeeweeABCMeta):
 
     @classmethod
     def random(cls, as_guest=False, mode=[].copy()):
-        files = cls.select().where(cls.as_guest==as_guest)
-        files = files.where(cls.mode.in_(mode))
-        files_count = files.count()
-        if not files_count:
+        files = cls.random_sample(1, as_guest, mode)
+        if not files:
             return None
-        return files[randint(0, files_count-1)]
+        return files[0]
+
+    @classmethod
+    def random_sample(cls, n: int, as_guest: bool = False, modes=(FileMode.RENDER, FileMode.SOURCE)) -> list["File"]:
+        """Return up to `n` distinct random files, drawn by random ids instead of offsets"""
+        min_id, max_id = cls.select(fn.MIN(cls.id), fn.MAX(cls.id)).scalar(as_tuple=True)
+        if min_id is None or not modes:
+            return []
+        condition = (cls.as_guest == as_guest) & cls.mode.in_(list(modes))
+        files = {}
+        # ids of deleted or not matching files get rejected, draw more as they show up
+        hit_rate = 1.0
+        for _ in range(RANDOM_SAMPLE_ROUNDS):
+            needed = n - len(files)
+            draw = min(int(needed / hit_rate * 1.5) + 1, RANDOM_SAMPLE_MAX_DRAW, max_id - min_id + 1)
+            ids = {randint(min_id, max_id) for _ in range(draw)} - files.keys()
+            found = list(cls.select().where(cls.id.in_(list(ids)), condition)) if ids else []
+            for file in found:
+                files[file.id] = file
+            if len(files) >= n:
+                break
+            hit_rate = max(len(found) / max(len(ids), 1), 0.01)
+        else:
+            # too few matching files for drawing, pick from all of them
+            rest = cls.select().where(condition, cls.id.not_in(list(files))).order_by(fn.Random()).limit(n - len(files))
+            for file in rest:
+                files[file.id] = file
+        files = list(files.values())[:n]
+        shuffle(files)
+        return files
+
+    @classmethod
+    def prefetch(cls, files) -> list["File"]:
+        """Load users, blobs and comment counts of `files` in bulk, for listings"""
+        from .comment import Comment
+        from .user import User
+        files = [file for file in files if file]
+        if not files:
+            return files
+        users = User.by_ids(file.user_id for file in files if not file.as_guest)
+        Blob.by_hashes(file.blob_hash for file in files)
+        comments_counts = dict(Comment.select(
+                Comment.file_id,
+                fn.COUNT(Comment.id)
+            ).where(
+                Comment.file_id.in_([file.id for file in files])
+            ).group_by(Comment.file_id).tuples())
+        for file in files:
+            file.__user = users.get(file.user_id)
+            file.__comments_count = comments_counts.get(file.id, 0)
+        return files
 
     @classmethod
     def get_blob_dependents(cls, blob):
@@ -202,6 +403,11 @@ class File(Model, BlobDependent, metaclass=PeeweeABCMeta):
             blob_hash = blob
         return cls.select().where(cls.blob_hash == blob_hash)
 
+    @classmethod
+    def referenced_blob_hashes(cls):
+        for blob_hash, in cls.select(cls.blob_hash).distinct().tuples().iterator():
+            yield blob_hash
+
     @classmethod
     def new_guest_path(cls, filename: str) -> str:
         ext = filename.split(".")[-1]
@@ -237,15 +443,18 @@ class File(Model, BlobDependent, metaclass=PeeweeABCMeta):
         return str(size) + " " + units[degre] + "B"
 
     def highlighted_html(self, linenos=False) -> str | None:
-        try:
-            lexer = lexers.get_lexer_for_filename(self.name)
-        except:
-            lexer = text_lexer
-        if linenos:
-            formatter = html_formatter_with_linenos
-        else:
-            formatter = html_formatter
-        return highlight(self.text, lexer, formatter)
+        return self.blob.highlighted_html(self.lexer, linenos)
+
+    def highlighted_lines_html(self, start: int = 0, count: int = SOURCE_WINDOW_LINES) -> str:
+        return self.blob.highlighted_lines_html(self.lexer, start, count)
+
+    def line_count(self) -> int:
+        return self.blob.line_count()
+
+    @property
+    def windowed_source(self) -> bool:
+        """Whether source is too large to be highlighted whole"""
+        return self.size > HIGHLIGHT_WHOLE_MAX_SIZE * 1024
 
     def unlock(self, password: str) -> bool:
         if self.password == password:
@@ -255,11 +464,25 @@ class File(Model, BlobDependent, metaclass=PeeweeABCMeta):
     def unlock_without_password(self):
         self.__unlocked = True
 
-    def hit(self):
-        self.views += 1
+    def hit(self) -> bool:
+        """Count a view, returns False if the file was a view once file already seen by someone else"""
         if self.visibility == FileVisibility.ONCE:
+            # only one concurrent viewer can win the transition
+            seen = File.update(
+                    views = File.views + 1,
+                    visibility = FileVisibility.HIDDEN,
+                ).where(
+                    File.id == self.id,
+                    File.visibility == FileVisibility.ONCE
+                ).execute()
             self.visibility = FileVisibility.HIDDEN
-        self.save()
+            if not seen:
+                return False
+            self.queue_for_indexing()
+        else:
+            views_counter.add(self.id)
+        self.views += 1
+        return True
 
     def update_modified_time(self):
         self.modified = datetime.now(UTC)
@@ -284,7 +507,7 @@ class File(Model, BlobDependent, metaclass=PeeweeABCMeta):
     def preview(self) -> str:
         if self.is_locked:
             return ""
-        return self.blob.get_str()[:128]
+        return self.blob.get_preview()
 
     def set_password(self, password: str):
         self.password = password[:64]
@@ -325,7 +548,7 @@ class File(Model, BlobDependent, metaclass=PeeweeABCMeta):
                 content = self.blob.get_base64()
             else:
                 content = None
-            blob_hash = self.blob.hash
+            blob_hash = self.blob_hash
         else:
             content = None
             blob_hash = None
@@ -368,6 +591,10 @@ class File(Model, BlobDependent, metaclass=PeeweeABCMeta):
             return False
         return self.rename(new_name)
 
+    @property
+    def lexer(self) -> Lexer:
+        return FileType.lexer(self.name)
+
     @property
     def ext(self) -> str:
         return self.name.split(".")[-1]
@@ -392,14 +619,21 @@ class File(Model, BlobDependent, metaclass=PeeweeABCMeta):
         from .user import User
         if self.as_guest:
             return User.guest
-        user = User.by_id(self.user_id)
-        return user
+        if self.__user is None or self.__user.id != self.user_id:
+            self.__user = User.by_id(self.user_id)
+        return self.__user
 
     @property
     def comments(self):
         from .comment import Comment
         return Comment.select().where(Comment.file_id==self.id)
 
+    @property
+    def comments_count(self) -> int:
+        if self.__comments_count is None:
+            self.__comments_count = self.comments.count()
+        return self.__comments_count
+
     @property
     def revisions(self):
         from .revision import Revision
@@ -407,11 +641,11 @@ class File(Model, BlobDependent, metaclass=PeeweeABCMeta):
 
     @property
     def type(self):
-        return FileType.filetype(self.name)
+        return self.file_type
 
     @property
     def mimetype(self):
-        return FileType.mimetype(self.name)
+        return self.mime
 
     @property
     def is_file(self) -> bool:
@@ -501,10 +735,6 @@ class File(Model, BlobDependent, metaclass=PeeweeABCMeta):
     def binary(self) -> bytes:
         return self.blob.get_binary()
 
-    @property
-    def size(self) -> int:
-        return self.blob.size
-
     @property
     def url(self) -> str:
         return f"{SCHEME}://{SERVER_NAME}{self.path}"
@@ -513,6 +743,119 @@ class File(Model, BlobDependent, metaclass=PeeweeABCMeta):
     def depends_on(self) -> list[Blob]:
         return [self.blob]
 
+class Directory(Model):
+    """ Directory with aggregates of its subtree, maintained along file writes """
+
+    class Meta:
+        database = file_db
+
+    path : str | CharField = CharField(max_length=4096, primary_key=True)
+    parent : str | CharField = CharField(max_length=4096, index=True)
+    files_count : int | IntegerField = IntegerField(default=0)   # files directly in it
+    subdirs_count : int | IntegerField = IntegerField(default=0) # directories directly in it
+    total_files : int | IntegerField = IntegerField(default=0)   # files anywhere below it
+    total_bytes : int | IntegerField = IntegerField(default=0)
+    modified : datetime | TimestampField = TimestampField(default=lambda:datetime.now(UTC))
+
+    def __repr__(self):
+        return f"<Directory '{self.path}'>"
+
+    @staticmethod
+    def ancestors_of(path: str) -> list[str]:
+        """Return paths of directories containing file `path`, outermost first"""
+        parts = path.split("/")[:-1]
+        return ["/".join(parts[:i+1]) + "/" for i in range(len(parts))]
+
+    @staticmethod
+    def parent_of(path: str) -> str:
+        """Return path of directory containing directory `path`, empty for root"""
+        return path[:path[:-1].rfind("/")+1]
+
+    @classmethod
+    def by_path(cls, path: str) -> "Directory":
+        return cls.get_or_none(cls.path == path)
+
+    @classmethod
+    def add_file(cls, path: str, size: int, modified: datetime):
+        """Count file at `path` in its directories, creating missing ones"""
+        ancestors = cls.ancestors_of(path)
+        existing = {dir_path for dir_path, in cls.select(cls.path).where(cls.path.in_(ancestors)).tuples()}
+        created = [dir_path for dir_path in ancestors if dir_path not in existing]
+        if created:
+            # created ones form a chain, each but the innermost holds the next one
+            cls.insert_many([
+                {"path": dir_path, "parent": cls.parent_of(dir_path), "subdirs_count": int(dir_path != created[-1]), "modified": modified}
+                for dir_path in created
+            ]).execute()
+            cls.update(subdirs_count=cls.subdirs_count + 1).where(
+                    cls.path == cls.parent_of(created[0])
+                    ).execute()
+        cls.update(
+                total_files = cls.total_files + 1,
+                total_bytes = cls.total_bytes + size,
+                modified = fn.MAX(cls.modified, cls.modified.db_value(modified)),
+            ).where(cls.path.in_(ancestors)).execute()
+        cls.update(files_count=cls.files_count + 1).where(cls.path == ancestors[-1]).execute()
+
+    @classmethod
+    def remove_file(cls, path: str, size: int):
+        """Uncount file at `path` from its directories, dropping emptied ones"""
+        ancestors = cls.ancestors_of(path)
+        cls.update(
+                total_files = cls.total_files - 1,
+                total_bytes = cls.total_bytes - size,
+                modified = datetime.now(UTC),
+            ).where(cls.path.in_(ancestors)).execute()
+        cls.update(files_count=cls.files_count - 1).where(cls.path == ancestors[-1]).execute()
+        emptied = [dir_path for dir_path, in cls.select(cls.path).where(
+                cls.path.in_(ancestors), cls.total_files <= 0
+                ).tuples()]
+        if emptied:
+            # emptied ones form a chain, only the outermost one has a parent left
+            emptied.sort(key=len)
+            cls.delete().where(cls.path.in_(emptied)).execute()
+            cls.update(subdirs_count=cls.subdirs_count - 1).where(
+                    cls.path == cls.parent_of(emptied[0])
+                    ).execute()
+
+    @classmethod
+    def touch(cls, path: str, modified: datetime):
+        """Record modification of file at `path` in its directories"""
+        cls.update(
+                modified = fn.MAX(cls.modified, cls.modified.db_value(modified))
+            ).where(cls.path.in_(cls.ancestors_of(path))).execute()
+
+    @classmethod
+    def rebuild(cls) -> int:
+        """Recompute all directories from files, returns number of directories"""
+        dirs = {}
+        for path, size, modified in File.select(File.path, File.size, File.modified).tuples().iterator():
+            ancestors = cls.ancestors_of(path)
+            for dir_path in ancestors:
+                dir = dirs.setdefault(dir_path, {
+                    "path": dir_path,
+                    "parent": cls.parent_of(dir_path),
+                    "files_count": 0,
+                    "subdirs_count": 0,
+                    "total_files": 0,
+                    "total_bytes": 0,
+                    "modified": modified,
+                })
+                dir["total_files"] += 1
+                dir["total_bytes"] += size
+                dir["modified"] = max(dir["modified"], modified)
+            dirs[ancestors[-1]]["files_count"] += 1
+        for dir in dirs.values():
+            if dir["parent"] in dirs:
+                dirs[dir["parent"]]["subdirs_count"] += 1
+
+        with file_db.atomic():
+            cls.delete().execute()
+            for batch in chunked(list(dirs.values()), 100):
+                cls.insert_many(batch).execute()
+        return len(dirs)
+
+
 class Dir:
     """ Directory """
 
@@ -527,6 +870,8 @@ class Dir:
             self.__dir += "/"
         if not self.__dir.startswith("/"):
             self.__dir = "/" + self.__dir
+        self.__directory = None
+        self.__directory_loaded = False
 
     def __repr__(self) -> str:
         return f"<Dir '{self.__dir}'>"
@@ -540,7 +885,7 @@ class Dir:
         return self.__dir == other.__dir
 
     def __len__(self) -> int:
-        return self.items().__len__()
+        return self.items_count()
 
     @property
     def name(self) -> str:
@@ -580,46 +925,87 @@ class Dir:
     def url(self) -> str:
         return f"{SCHEME}://{SERVER_NAME}{self.path}"
 
-    def items(self) -> List[Union["Dir", File]]:
-        """Return items of the directory"""
-        items_ = []
-        filepaths = map(lambda i:i.path, File.select().where(File.path.startswith(self.__dir)).order_by(File.path))
-        for path in filepaths:
-            if path.count("/") == self.__dir.count("/"):
-                items_.append(File.by_path(path))
-            else:
-                _dir = path[:path.find("/", len(self.__dir))]
-                dir = Dir(_dir)
-                if dir not in items_:
-                    items_.append(dir)
+    @property
+    def directory(self) -> Directory | None:
+        """Maintained aggregates of the directory, None if it holds no files"""
+        if not self.__directory_loaded:
+            self.__directory = Directory.by_path(self.__dir)
+            self.__directory_loaded = True
+        return self.__directory
+
+    @directory.setter
+    def directory(self, directory: Directory | None):
+        self.__directory = directory
+        self.__directory_loaded = True
+
+    @property
+    def total_files(self) -> int:
+        return self.directory.total_files if self.directory else 0
+
+    @property
+    def total_bytes(self) -> int:
+        return self.directory.total_bytes if self.directory else 0
+
+    @property
+    def modified(self) -> datetime | None:
+        return self.directory.modified if self.directory else None
+
+    def subdirs(self, sort: str = "name", reverse: bool = False) -> List["Dir"]:
+        """Return immediate subdirectories"""
+        order = {
+            "modified": Directory.modified,
+            "size": Directory.total_bytes,
+        }.get(sort, Directory.path)
+        query = Directory.select().where(Directory.parent == self.__dir).order_by(order.desc() if reverse else order)
+        dirs = []
+        for directory in query:
+            dir = Dir(directory.path)
+            dir.directory = directory
+            dirs.append(dir)
+        return dirs
+
+    def files(self, sort: str = "name", reverse: bool = False):
+        """Return query of files directly in the directory"""
+        order = {
+            "modified": File.modified,
+            "views": File.views,
+        }.get(sort, File.path)
+        return File.select().where(File.dir_path == self.__dir).order_by(order.desc() if reverse else order)
+
+    def items(
+            self,
+            sort: str = "name",
+            reverse: bool = False,
+            page: int | None = None,
+            page_size: int = 64
+        ) -> List[Union["Dir", File]]:
+        """Return items of the directory, subdirectories first, all of them or a page"""
+        dirs = self.subdirs(sort, reverse)
+        files = self.files(sort, reverse)
+        if page is None:
+            items_ = dirs + list(files)
+        else:
+            offset = (max(page, 1) - 1) * page_size
+            items_ = dirs[offset:offset+page_size]
+            files_limit = page_size - len(items_)
+            if files_limit > 0:
+                items_ += list(files.offset(max(offset - len(dirs), 0)).limit(files_limit))
+        File.prefetch(item for item in items_ if item.is_file)
         return items_
 
     def items_count(self) -> int:
         """Return numbres of items in the direttory"""
-        count = 0
-        seen_dirs = []
-        depth_count = self.__dir.count("/")
-        path_len = len(self.__dir)
-        filepaths = map(lambda i:i.path, File.select().where(File.path.startswith(self.__dir)).order_by(File.path))
-        for path in filepaths:
-            if path.count("/") == depth_count:
-                count += 1
-            else:
-                dir = path[:path.find("/", path_len)]
-                if dir not in seen_dirs:
-                    seen_dirs.append(dir)
-                    count += 1
-        return count
+        if not self.directory:
+            return 0
+        return self.directory.files_count + self.directory.subdirs_count
 
-    def to_dict(self, expand=True, expand_depth=1) -> dict:
+    def to_dict(self, expand=True, expand_depth=1, **kwargs) -> dict:
         if expand:
-            items = self.items()
+            items = self.items(**kwargs)
             for i, item in enumerate(items):
                 if item.is_file:
                     items[i] = item.to_dict(show_content=False)
                 if item.is_dir:
-                    print("name:", self.name)
-                    print("expand_depth:", expand_depth)
                     if expand_depth > 1:
                         items[i] = item.to_dict(expand=True, expand_depth=expand_depth-1)
                     else:
@@ -632,8 +1018,38 @@ class Dir:
             "username": self.username,
             "items": items,
             "items_count": self.items_count(),
+            "total_files": self.total_files,
+            "total_bytes": self.total_bytes,
             "url": self.url,
         }
 
 
-file_db.create_tables([File])
+views_counter = WriteBehindCounter(File, File.views)
+
+
+def backfill_file_metadata(model, name_field):
+    """Fill size, mime and file_type of existing rows of `model`, after add_missing_columns added them"""
+    with model._meta.database.atomic():
+        rows = list(model.select(model.id, name_field, model.blob_hash).tuples())
+        for batch in chunked(rows, 500):
+            blobs = Blob.by_hashes(blob_hash for _, _, blob_hash in batch)
+            for id, name, blob_hash in batch:
+                name = name.split("/")[-1]
+                model.update(
+                    size = blobs[blob_hash].size if blob_hash in blobs else 0,
+                    mime = FileType.mimetype(name),
+                    file_type = FileType.filetype(name),
+                ).where(model.id == id).execute()
+
+
+# before create_tables, it would index not yet existing columns as string literals
+added_columns = add_missing_columns(File) if File.table_exists() else []
+directory_table_exists = Directory.table_exists()
+file_db.create_tables([File, Directory])
+if "dir_path" in added_columns:
+    # path up to its last "/", rtrim strips trailing characters that are not "/"
+    File.update(dir_path=fn.rtrim(File.path, fn.replace(File.path, "/", ""))).execute()
+if "size" in added_columns:
+    backfill_file_metadata(File, File.path)
+if not directory_table_exists:
+    Directory.rebuild()
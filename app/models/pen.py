@@ -1,12 +1,11 @@
 from peewee import Model, SqliteDatabase, IntegerField, CharField, TimestampField
-from pygments import lexers, highlight
-from pygments.formatters import HtmlFormatter
+from pygments import lexers
 
 from datetime import datetime, UTC
 
 from .blob import Blob
 from .base import PeeweeABCMeta, BlobDependent
-from app.utils import randstr
+from app.utils import randstr, WriteBehindCounter, WriteBehindCounted
 from app.config import SCHEME, SERVER_NAME
 
 
@@ -20,11 +19,9 @@ pen_db = SqliteDatabase(
 html_lexer = lexers.get_lexer_by_name("html")
 css_lexer = lexers.get_lexer_by_name("css")
 js_lexer = lexers.get_lexer_by_name("js")
-html_formatter = HtmlFormatter()
-html_formatter_with_linenos = HtmlFormatter(linenos=True)
 
 
-class Pen(Model, BlobDependent, metaclass=PeeweeABCMeta):
+class Pen(WriteBehindCounted, Model, BlobDependent, metaclass=PeeweeABCMeta):
     """ Pen """
 
     class Meta:
@@ -40,6 +37,8 @@ class Pen(Model, BlobDependent, metaclass=PeeweeABCMeta):
     views : int | IntegerField = IntegerField(default=0)
     modified : datetime | TimestampField = TimestampField(default=datetime.now(UTC))
 
+    __user : "User | None" = None
+
     def __repr__(self):
         return f"<Pen: {self.id}>"
 
@@ -47,6 +46,19 @@ class Pen(Model, BlobDependent, metaclass=PeeweeABCMeta):
     def by_id(cls, id):
         return cls.get_or_none(cls.id==id)
 
+    @classmethod
+    def prefetch(cls, pens) -> list["Pen"]:
+        """Load users and blobs of `pens` in bulk, for listings"""
+        from .user import User
+        pens = [pen for pen in pens if pen]
+        if not pens:
+            return pens
+        users = User.by_ids(pen.user_id for pen in pens)
+        Blob.by_hashes(hash for pen in pens for hash in pen.blob_dependencies)
+        for pen in pens:
+            pen.__user = users.get(pen.user_id)
+        return pens
+
     @classmethod
     def get_blob_dependents(cls, blob):
         if not isinstance(blob, str):
@@ -60,6 +72,12 @@ class Pen(Model, BlobDependent, metaclass=PeeweeABCMeta):
             (cls.js_blob_hash == blob_hash)
         ))
 
+    @classmethod
+    def referenced_blob_hashes(cls):
+        query = cls.select(cls.head_blob_hash, cls.body_blob_hash, cls.css_blob_hash, cls.js_blob_hash)
+        for blob_hashes in query.tuples().iterator():
+            yield from blob_hashes
+
     @classmethod
     def new_id(cls) -> str:
         id = randstr(8)
@@ -67,47 +85,55 @@ class Pen(Model, BlobDependent, metaclass=PeeweeABCMeta):
             id = randstr(8)
         return id
 
+    def save(self, force_insert: bool = False, only: list | None = None):
+        saved = super().save(force_insert, only)
+        for blob_hash, lexer in (
+                (self.head_blob_hash, html_lexer),
+                (self.body_blob_hash, html_lexer),
+                (self.css_blob_hash, css_lexer),
+                (self.js_blob_hash, js_lexer),
+            ):
+            Blob.request_highlight(blob_hash, lexer, linenos=True)
+        self.queue_for_indexing()
+        return saved
+
+    def delete_instance(self, *args, **kwargs):
+        deleted = super().delete_instance(*args, **kwargs)
+        if deleted:
+            self.queue_for_indexing()
+        return deleted
+
+    def queue_for_indexing(self):
+        from .search import SearchIndexQueue
+        SearchIndexQueue.push_item(self)
+
     def hit(self):
+        views_counter.add(self.id)
         self.views += 1
-        self.save()
 
     def update_modified_time(self):
         self.modified = datetime.now(UTC)
         self.save()
 
     def highlighted_head_html(self, linenos=False) -> str:
-        if linenos:
-            formatter = html_formatter_with_linenos
-        else:
-            formatter = html_formatter
-        return highlight(self.head_content, html_lexer, formatter)
+        return self.head_blob.highlighted_html(html_lexer, linenos)
 
     def highlighted_body_html(self, linenos=False) -> str:
-        if linenos:
-            formatter = html_formatter_with_linenos
-        else:
-            formatter = html_formatter
-        return highlight(self.body_content, html_lexer, formatter)
+        return self.body_blob.highlighted_html(html_lexer, linenos)
 
     def highlighted_css_html(self, linenos=False) -> str:
-        if linenos:
-            formatter = html_formatter_with_linenos
-        else:
-            formatter = html_formatter
-        return highlight(self.css_content, css_lexer, formatter)
+        return self.css_blob.highlighted_html(css_lexer, linenos)
 
     def highlighted_js_html(self, linenos=False) -> str:
-        if linenos:
-            formatter = html_formatter_with_linenos
-        else:
-            formatter = html_formatter
-        return highlight(self.js_content, js_lexer, formatter)
+        return self.js_blob.highlighted_html(js_lexer, linenos)
 
     def to_dict(self, **kwargs):
         show_head_content = kwargs.get("show_head_content", False)
         show_body_content = kwargs.get("show_body_content", False)
         show_css_content = kwargs.get("show_css_content", False)
         show_js_content = kwargs.get("show_js_content", False)
+        if show_head_content or show_body_content or show_css_content or show_js_content:
+            Blob.by_hashes(self.blob_dependencies)
 
         return {
             "id": self.id,
@@ -140,7 +166,9 @@ class Pen(Model, BlobDependent, metaclass=PeeweeABCMeta):
     @property
     def user(self):
         from .user import User
-        return User.by_id(self.user_id)
+        if self.__user is None or self.__user.id != self.user_id:
+            self.__user = User.by_id(self.user_id)
+        return self.__user
 
     @property
     def head_blob(self) -> Blob:
@@ -231,4 +259,6 @@ class Pen(Model, BlobDependent, metaclass=PeeweeABCMeta):
         return f"{SCHEME}://{SERVER_NAME}/pen/{self.id}"
 
 
+views_counter = WriteBehindCounter(Pen, Pen.views)
+
 pen_db.create_tables([Pen])
@@ -31,6 +31,11 @@ class Revision(Model, BlobDependent, metaclass=PeeweeABCMeta):
             blob_hash = blob
         return cls.select().where(cls.blob_hash == blob_hash)
 
+    @classmethod
+    def referenced_blob_hashes(cls):
+        for blob_hash, in cls.select(cls.blob_hash).distinct().tuples().iterator():
+            yield blob_hash
+
     @classmethod
     def make_for(cls, file):
         from .file import File
@@ -1,8 +1,12 @@
-from peewee import SqliteDatabase, Model, CharField, IntegerField, FloatField, TimestampField
+from peewee import SqliteDatabase, Model, AutoField, CharField, IntegerField, FloatField, TimestampField, chunked
+from playhouse.sqlite_ext import FTS5Model, SearchField, RowIDField
 
+from collections import defaultdict
 from datetime import datetime, UTC
-from time import sleep
+from threading import Event
+from time import time
 
+from .base import add_missing_columns
 from .file import File
 from .pen import Pen
 
@@ -15,6 +19,11 @@ search_db = SqliteDatabase(
             "busy_timeout": 8000,
         })
 
+search_index_event = Event() # set when an item gets queued for indexing
+
+SEARCH_RETRY_DELAY = 60 # seconds before first retry of an item failing to index, doubles per attempt
+SEARCH_RETRY_MAX_DELAY = 6 * 3600
+
 class SearchResultItemType:
     FILE = 1
     PEN  = 2
@@ -23,6 +32,20 @@ class SearchResultItemType:
     pen  = 2
 
 
+indexed_items = {SearchResultItemType.FILE: File, SearchResultItemType.PEN: Pen}
+
+
+def existing_item_ids(item_type: int, item_ids: list[str] | None = None) -> set[str]:
+    """Ids of existing items of `item_type`, limited to `item_ids` if given, in one query"""
+    Item = indexed_items.get(item_type)
+    if Item is None:
+        return set()
+    query = Item.select(Item.id)
+    if item_ids is not None:
+        query = query.where(Item.id.in_(item_ids))
+    return {str(id) for id, in query.tuples().iterator()}
+
+
 class SearchIndexStatus(Model):
     class Meta:
         database = search_db
@@ -61,40 +84,37 @@ class SearchIndexStatus(Model):
         self.last_index_views = views
         self.save()
 
+    def mark_indexed(self, views: int):
+        """Record indexing of item with `views` views now, in one write"""
+        self.last_index_views = views
+        self.last_index_time = datetime.now(UTC)
+        self.save()
 
-class SearchResult(Model):
-    class Meta:
-        database = search_db
 
-    token:     str   | CharField    = CharField(16,  index=True)
-    score:     float | FloatField   = FloatField()
-    item_type: int   | IntegerField = IntegerField() # SearchResultItemType
-    item_id:   str   | CharField    = CharField(16)
+class SearchHit:
+    """ Search result of an item, loads its file or pen """
 
-    @classmethod
-    def purge(cls):
-        rs = cls.select()
-        for r in rs:
-            if not r.item:
-                cls.delete().where(
-                    cls.item_type==r.item_type
-                    ).where(
-                    cls.item_id==cls.item_id
-                    ).execute()
-            sleep(0.1)
+    __item : File | Pen | None = None
+    __item_loaded : bool = False
 
     @classmethod
-    def for_item(cls, item: File | Pen):
-        item_type = 0
-        item_id = ""
-        if isinstance(item, File):
-            item_type = SearchResultItemType.FILE
-            item_id = str(item.id)
-        if isinstance(item, Pen):
-            item_type = SearchResultItemType.PEN
-            item_id = str(item.id)
-
-        return cls.select().where(cls.item_id==item_id).where(cls.item_type==item_type)
+    def prefetch(cls, results) -> list["SearchHit"]:
+        """Load items of `results` in bulk, and what their cards show, for listings"""
+        results = list(results)
+        file_ids = [int(r.item_id) for r in results if r.item_type == SearchResultItemType.FILE]
+        pen_ids = [r.item_id for r in results if r.item_type == SearchResultItemType.PEN]
+        files = {str(file.id): file for file in File.select().where(File.id.in_(file_ids))} if file_ids else {}
+        pens = {pen.id: pen for pen in Pen.select().where(Pen.id.in_(pen_ids))} if pen_ids else {}
+        File.prefetch(files.values())
+        Pen.prefetch(pens.values())
+        for result in results:
+            match result.item_type:
+                case SearchResultItemType.FILE:
+                    result.__item = files.get(result.item_id)
+                case SearchResultItemType.PEN:
+                    result.__item = pens.get(result.item_id)
+            result.__item_loaded = True
+        return results
 
     @property
     def item_type_s(self) -> str:
@@ -108,12 +128,16 @@ class SearchResult(Model):
 
     @property
     def item(self) -> File | Pen | None:
+        if self.__item_loaded:
+            return self.__item
         item = None
         match self.item_type:
             case SearchResultItemType.FILE:
                 item = File.by_id(self.item_id)
             case SearchResultItemType.PEN:
                 item = Pen.by_id(self.item_id)
+        self.__item = item
+        self.__item_loaded = True
         return item
 
     @property
@@ -131,4 +155,219 @@ class SearchResult(Model):
         return str(item.url)
 
 
-search_db.create_tables([SearchIndexStatus, SearchResult])
+class SearchResult(Model, SearchHit):
+    class Meta:
+        database = search_db
+        indexes = (
+            (("item_type", "item_id"), False),
+        )
+
+    token:     str   | CharField    = CharField(16,  index=True)
+    score:     float | FloatField   = FloatField()
+    item_type: int   | IntegerField = IntegerField() # SearchResultItemType
+    item_id:   str   | CharField    = CharField(16)
+
+    @classmethod
+    def purge(cls, chunk_size: int = 500, progress = None) -> dict:
+        """ Delete rows of items that no longer exist, returns number of items and rows removed """
+        # mark, id of every existing item in one query per table
+        live = {item_type: existing_item_ids(item_type) for item_type in indexed_items}
+
+        # sweep, each indexed item once
+        orphans = [
+            (item_type, item_id)
+            for item_type, item_id in cls.select(
+                    cls.item_type, cls.item_id
+                ).group_by(cls.item_type, cls.item_id).tuples().iterator()
+            if item_id not in live.get(item_type, ())
+        ]
+
+        purged = {"items": 0, "rows": 0}
+        for chunk in chunked(orphans, chunk_size):
+            by_type = defaultdict(set)
+            for item_type, item_id in chunk:
+                by_type[item_type].add(item_id)
+            with search_db.atomic():
+                for item_type, item_ids in by_type.items():
+                    # got created after marking
+                    item_ids -= existing_item_ids(item_type, list(item_ids))
+                    if not item_ids:
+                        continue
+                    purged["rows"] += cls.delete().where(
+                        cls.item_type==item_type
+                        ).where(
+                        cls.item_id.in_(list(item_ids))
+                        ).execute()
+                    purged["items"] += len(item_ids)
+            if progress:
+                progress(purged)
+        return purged
+
+    @classmethod
+    def for_item(cls, item: File | Pen):
+        item_type = 0
+        item_id = ""
+        if isinstance(item, File):
+            item_type = SearchResultItemType.FILE
+            item_id = str(item.id)
+        if isinstance(item, Pen):
+            item_type = SearchResultItemType.PEN
+            item_id = str(item.id)
+
+        return cls.select().where(cls.item_id==item_id).where(cls.item_type==item_type)
+
+
+class IntegerSearchField(SearchField):
+    """ Unindexed full text search column holding an integer """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, unindexed=True, **kwargs)
+
+    def python_value(self, value):
+        return None if value is None else int(value)
+
+
+class SearchDocument(FTS5Model, SearchHit):
+    """ Full text search document of an item, rowid is id of its SearchIndexStatus """
+
+    class Meta:
+        database = search_db
+        options = {
+            "tokenize": "unicode61 remove_diacritics 2",
+            "prefix": "2 3",
+        }
+
+    rowid = RowIDField()
+    item_type: int   | IntegerSearchField = IntegerSearchField() # SearchResultItemType
+    item_id:   str   | SearchField        = SearchField(unindexed=True)
+    boost:     float | SearchField        = SearchField(unindexed=True) # rank bonus of views
+    title:     str   | SearchField        = SearchField()
+    content:   str   | SearchField        = SearchField()
+
+    # bm25 weights in column order, matches in title count more than in content
+    weights = (0.0, 0.0, 0.0, 3.0, 1.0)
+
+    @classmethod
+    def ranked(cls, query: str):
+        """Documents matching fts5 `query`, best first"""
+        # bm25 is negative, lower for better matches
+        rank = cls.bm25(*cls.weights) - cls.boost
+        return cls.select(
+                cls.rowid, cls.item_type, cls.item_id
+            ).where(
+                cls.match(query)
+            ).order_by(rank)
+
+    @classmethod
+    def purge(cls, chunk_size: int = 500, progress = None) -> dict:
+        """ Delete documents and index statuses of items that no longer exist, returns number of items and documents removed """
+        # mark, id of every existing item in one query per table
+        live = {item_type: existing_item_ids(item_type) for item_type in indexed_items}
+
+        # sweep, statuses of every indexed item, a document's rowid is its status id
+        orphans = [
+            (id, item_type, item_id)
+            for id, item_type, item_id in SearchIndexStatus.select(
+                    SearchIndexStatus.id, SearchIndexStatus.item_type, SearchIndexStatus.item_id
+                ).tuples().iterator()
+            if item_id not in live.get(item_type, ())
+        ]
+
+        purged = {"items": 0, "rows": 0}
+        for chunk in chunked(orphans, chunk_size):
+            by_type = defaultdict(dict)
+            for id, item_type, item_id in chunk:
+                by_type[item_type][item_id] = id
+            with search_db.atomic():
+                for item_type, status_ids in by_type.items():
+                    # got created after marking
+                    for item_id in existing_item_ids(item_type, list(status_ids)):
+                        del status_ids[item_id]
+                    if not status_ids:
+                        continue
+                    ids = list(status_ids.values())
+                    purged["rows"] += cls.delete().where(cls.rowid.in_(ids)).execute()
+                    SearchIndexStatus.delete().where(SearchIndexStatus.id.in_(ids)).execute()
+                    purged["items"] += len(ids)
+            if progress:
+                progress(purged)
+        return purged
+
+
+class SearchIndexQueue(Model):
+    """ Items changed since they were last indexed, at most one row per item """
+
+    class Meta:
+        database = search_db
+        indexes = (
+            (("item_type", "item_id"), True),
+        )
+
+    id:          int   | AutoField    = AutoField()
+    item_type:   int   | IntegerField = IntegerField() # SearchResultItemType
+    item_id:     str   | CharField    = CharField()
+    attempts:    int   | IntegerField = IntegerField(default=0) # failed indexing attempts
+    retry_after: float | FloatField   = FloatField(default=0) # unix time
+
+    @classmethod
+    def push(cls, item_type: int, item_id: str):
+        # replacing gives a new id, so a push while the item is being indexed is not dropped by done()
+        cls.insert(item_type=item_type, item_id=str(item_id)).on_conflict_replace().execute()
+        search_index_event.set()
+
+    @classmethod
+    def push_item(cls, item: File | Pen):
+        if isinstance(item, File):
+            cls.push(SearchResultItemType.FILE, item.id)
+        if isinstance(item, Pen):
+            cls.push(SearchResultItemType.PEN, item.id)
+
+    @classmethod
+    def push_all(cls):
+        """Queue every file and pen"""
+        for Item, item_type in ((File, SearchResultItemType.FILE), (Pen, SearchResultItemType.PEN)):
+            for ids in chunked(Item.select(Item.id).tuples().iterator(), 400):
+                with search_db.atomic():
+                    cls.insert_many(
+                        [(item_type, str(id)) for id, in ids],
+                        fields=[cls.item_type, cls.item_id]
+                    ).on_conflict_replace().execute()
+        search_index_event.set()
+
+    @staticmethod
+    def wait(timeout: float | None = None) -> bool:
+        """Wait until something gets queued by this process, returns False on timeout"""
+        queued = search_index_event.wait(timeout)
+        search_index_event.clear()
+        return queued
+
+    @classmethod
+    def batch(cls, limit: int = 100) -> list["SearchIndexQueue"]:
+        """Oldest queued items, failed ones once their retry is due"""
+        return list(cls.select().where(cls.retry_after <= time()).order_by(cls.id).limit(limit))
+
+    @classmethod
+    def retry_later(cls, entries: list["SearchIndexQueue"]):
+        """Keep failed `entries` queued, retried after a delay doubling with each attempt"""
+        for entry in entries:
+            delay = min(SEARCH_RETRY_DELAY * 2 ** entry.attempts, SEARCH_RETRY_MAX_DELAY)
+            # pushed again meanwhile, replaced by a new entry retried right away
+            cls.update(
+                    attempts = cls.attempts + 1,
+                    retry_after = time() + delay,
+                ).where(cls.id == entry.id).execute()
+
+    @classmethod
+    def done(cls, entries: list["SearchIndexQueue"]):
+        """Remove indexed `entries`, items queued again meanwhile stay"""
+        cls.delete().where(cls.id.in_([entry.id for entry in entries])).execute()
+
+
+search_document_table_exists = SearchDocument.table_exists()
+search_index_queue_exists = SearchIndexQueue.table_exists()
+if search_index_queue_exists:
+    add_missing_columns(SearchIndexQueue)
+search_db.create_tables([SearchIndexStatus, SearchResult, SearchDocument, SearchIndexQueue])
+if not search_document_table_exists or not search_index_queue_exists:
+    # indexed before full text search or by sweeping daemon, index all once
+    SearchIndexQueue.push_all()
@@ -1,12 +1,12 @@
 from peewee import Model, SqliteDatabase, AutoField, IntegerField, TextField, CharField
 
-from ..utils import randstr
+from ..utils import randstr, WriteBehindCounter, WriteBehindCounted
 from ..config import SCHEME, SERVER_NAME
 
 shortlink_db = SqliteDatabase("instance/shortlinks.db")
 
 
-class ShortLink(Model):
+class ShortLink(WriteBehindCounted, Model):
     """ ShortLink """
 
     class Meta:
@@ -41,8 +41,8 @@ class ShortLink(Model):
         return sl
 
     def hit(self):
+        visits_counter.add(self.id)
         self.visits += 1
-        self.save()
 
     def to_dict(self) -> dict:
         return {
@@ -58,4 +58,6 @@ class ShortLink(Model):
         return f"{SCHEME}://{SERVER_NAME}/r/{self.short}"
 
 
+visits_counter = WriteBehindCounter(ShortLink, ShortLink.visits)
+
 shortlink_db.create_tables([ShortLink])
@@ -1,10 +1,10 @@
-from peewee import Model, SqliteDatabase, AutoField, CharField, DateTimeField, TextField
+from peewee import Model, SqliteDatabase, AutoField, CharField, DateTimeField, IntegerField, TextField
 
 from datetime import datetime, timedelta, UTC
-from io import BytesIO
 
 from .blob import Blob
-from .base import PeeweeABCMeta, BlobDependent
+from .base import PeeweeABCMeta, BlobDependent, add_missing_columns
+from .file import FileType, backfill_file_metadata
 from app.utils.helpers import randstr
 from app.config import SCHEME, SERVER_NAME
 
@@ -19,7 +19,17 @@ class TmpFile(Model, BlobDependent, metaclass=PeeweeABCMeta):
     blob_hash : str | CharField = CharField(64)
     password : str | CharField = CharField(default="")
     expiry = DateTimeField(default=lambda:datetime.now(UTC)+timedelta(days=1))
-    
+    size : int | IntegerField = IntegerField(default=0)
+    mime : str | CharField = CharField(max_length=255, default="unknown/unknown")
+    file_type : int | IntegerField = IntegerField(default=FileType.UNKNOWN)
+
+    def save(self, *args, **kwargs):
+        self.mime = FileType.mimetype(self.name)
+        self.file_type = FileType.filetype(self.name)
+        blob = self.blob
+        self.size = blob.size if blob else 0
+        return super().save(*args, **kwargs)
+
     @classmethod
     def by_code(cls, code: str) -> "TmpFile":
         return cls.get_or_none(cls.code == code)
@@ -32,17 +42,22 @@ class TmpFile(Model, BlobDependent, metaclass=PeeweeABCMeta):
             blob_hash = blob
         return cls.select().where(cls.blob_hash == blob_hash)
 
+    @classmethod
+    def referenced_blob_hashes(cls):
+        for blob_hash, in cls.select(cls.blob_hash).distinct().tuples().iterator():
+            yield blob_hash
+
     @classmethod
     def create_with_buffer(cls, buffer) -> "TmpFile":
         name = buffer.name if buffer.name else "TmpFile"
-        tb = BytesIO()
-        
+
         if buffer.__class__.__name__ == "FileStorage": # werkzeug's datastructer
-            buffer.save(tb)
+            stream = buffer.stream
         else:
-            tb.write(buffer.getvalue())
+            stream = buffer
+            stream.seek(0)
 
-        blob = Blob.create(tb.getvalue())
+        blob = Blob.create_from_stream(stream)
         tf = cls.create_with_blob(blob, name)
         return tf
 
@@ -69,8 +84,7 @@ class TmpFile(Model, BlobDependent, metaclass=PeeweeABCMeta):
 
     def get_file(self):
         try:
-            f = open(self.filepath, "rb")
-            return f
+            return self.blob.open()
         except:
             return None
 
@@ -79,6 +93,8 @@ class TmpFile(Model, BlobDependent, metaclass=PeeweeABCMeta):
             "name": self.name,
             "code": self.code,
             "blob_hash": self.blob_hash,
+            "size": self.size,
+            "mime": self.mime,
             "content": self.blob.get_base64() if show_content else None,
             "expire": self.expiry,
             "url": f"{SCHEME}://{SERVER_NAME}/tmp/{self.code}"
@@ -169,3 +185,5 @@ class TmpFolder(Model):
         return tmp_files
 
 tmpfile_db.create_tables([TmpFile, TmpFolder])
+if "size" in add_missing_columns(TmpFile):
+    backfill_file_metadata(TmpFile, TmpFile.name)
@@ -93,6 +93,10 @@ class User(Model):
     def by_api_key(cls, api_key) -> "User":
         return cls.get_or_none(cls.api_key==api_key)
 
+    @classmethod
+    def by_ids(cls, ids) -> dict[int, "User"]:
+        return {user.id: user for user in cls.select().where(cls.id.in_(list(set(ids))))}
+
     @classmethod
     def by_username(cls, username) -> "User":
         return cls.get_or_none(cls.username==username)
@@ -1,9 +1,7 @@
 from flask import request, g
 
 import binascii
-import os
 
-from app.utils.helpers import randstr, file_path
 from app.utils.git import git_clone
 from app.models import Blob, File, FileMode, FileVisibility, Dir
 from .api import *
@@ -15,7 +13,11 @@ def list_dir_items():
     dir = Dir(dir)
     if dir.username != g.auth_user.username:
         return error_respones_dict(APIErrors.FORBIDDEN), 403
-    return dir.to_dict()
+    sort = request.args.get("sort", "name")
+    reverse = request.args.get("reverse", "false") == "true"
+    page = request.args.get("page", None, int)
+    page_size = min(request.args.get("page_size", 64, int), 256)
+    return dir.to_dict(sort=sort, reverse=reverse, page=page, page_size=page_size)
 
 
 @private_api.get("/file")
@@ -78,10 +80,7 @@ def create_file():
 
     if _file:
         try:
-            tmp_filepath = file_path("tmp", randstr(10))
-            _file.save(tmp_filepath)
-            blob = Blob.from_file(tmp_filepath)
-            os.remove(tmp_filepath)
+            blob = Blob.create_from_stream(_file.stream)
         except:
             return error_respones_dict(APIErrors.INTERNAL_ERROR), 500
 
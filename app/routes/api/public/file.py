@@ -1,8 +1,10 @@
-from flask import request, g
+from flask import request, g, make_response
 
 import binascii
+from json import dumps
 
 from app.models import Blob, File, FileMode, FileVisibility
+from app.utils import hash_sha256
 from .api import *
 
 
@@ -37,10 +39,20 @@ def get_file_():
     if file.is_locked:
         return error_respones_dict(APIErrors.UNAUTHORIZED)
 
-    return {
+    # validator covers every field returned, views and owner change without touching the blob
+    meta = file.to_dict(show_content=False)
+    etag = hash_sha256(f"{dumps(meta, sort_keys=True)}-{int(show_content)}")
+    if request.if_none_match.contains_weak(etag):
+        response = make_response("", 304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    response = make_response({
         "success": True,
-        "file": file.to_dict(show_content=show_content)
-    }
+        "file": file.to_dict(show_content=True) if show_content else meta
+    })
+    response.set_etag(etag, weak=True)
+    return response
 
 
 @public_api.post("/file")
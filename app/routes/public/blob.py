@@ -1,7 +1,7 @@
 from flask import render_template, abort
 
 from app.models import Blob, BlobType
-from .public import public
+from .public import public, send_blob, blob_not_modified, set_immutable
 
 
 @public.route("/blob/")
@@ -11,10 +11,12 @@ def blob_lookup():
 
 @public.route("/blob/<hash>")
 def blob_(hash):
+    if response := blob_not_modified(hash):
+        return set_immutable(response)
     blob = Blob[hash]
     if not blob:
         abort(404)
     if blob.type == BlobType.TEXT:
-        return blob.get_content(), { "Content-type": "text/text" }
-    return blob.get_content(), { "Content-type": "application/octet-stream" }
+        return send_blob(blob, mimetype="text/text", immutable=True)
+    return send_blob(blob, mimetype="application/octet-stream", immutable=True)
 
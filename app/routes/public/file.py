@@ -1,8 +1,9 @@
-from flask import render_template, request, g, session, send_file, abort
+from flask import render_template, request, g, session, abort, jsonify
 
 from app.models import User, BlobType, File, FileMode, FileVisibility, Dir
+from app.models.file import SOURCE_WINDOW_LINES
 from app.services.executor import Executor
-from .public import public
+from .public import public, send_blob, blob_not_modified, page_etag, not_modified
 
 
 @public.route("/<username>/<path:path>", methods=["GET", "POST"])
@@ -38,17 +39,23 @@ def user_file(username, path):
                 return render_template("locked-file.html")
             session["passwords"][str(file.id)] = password
 
-    file.hit()
+    if not file.hit() and (not g.user or file.user != g.user):
+        return render_template("hidden-file.html"), 403
+
+    # source pages show view count, which changes on every hit, only rendered blobs get validators
+    if file.mode == FileMode.RENDER:
+        if response := blob_not_modified(file.blob_hash):
+            return response
 
     # Binary files
     if file.blob.type == BlobType.BINARY:
         if file.mode == FileMode.RENDER:
-            return send_file(file.blob.filepath, download_name=file.name)
+            return send_blob(file.blob, download_name=file.name)
         return render_template("file-src.html", file=file)
 
     # Text files 
     if file.mode == FileMode.RENDER:
-        return file.content, { "Content-Type": file.mimetype }
+        return send_blob(file.blob, mimetype=file.mimetype)
 
     executors = Executor.suggest_executors(file.name)
 
@@ -81,11 +88,15 @@ def raw_file(path):
                 return render_template("locked-file.html")
             session["passwords"][str(file.id)] = password
 
-    file.hit()
+    if not file.hit() and (not g.user or file.user != g.user):
+        return render_template("hidden-file.html"), 403
+
+    if response := blob_not_modified(file.blob_hash):
+        return response
 
     if file.blob.type == BlobType.TEXT:
-        return send_file(file.blob.filepath, mimetype="text/text", download_name=file.name)
-    return send_file(file.blob.filepath, mimetype=file.mimetype, download_name=file.name)
+        return send_blob(file.blob, mimetype="text/text", download_name=file.name)
+    return send_blob(file.blob, mimetype=file.mimetype, download_name=file.name)
 
 
 @public.route("/src/<path:path>")
@@ -113,9 +124,39 @@ def file_src(path):
                 return render_template("locked-file.html")
             session["passwords"][str(file.id)] = password
 
-    file.hit()
-    
+    if "start" in request.args:
+        return source_window(file)
+
+    if not file.hit() and (not g.user or file.user != g.user):
+        return render_template("hidden-file.html"), 403
+
     executors = Executor.suggest_executors(file.name)
 
     return render_template("file-src.html", file=file, executors=executors)
 
+
+
+def source_window(file: File):
+    """Highlighted html of a window of lines of `file`, fetched by windowed source view"""
+    if file.blob.type != BlobType.TEXT:
+        return jsonify({"error": "not a text file"}), 400
+    # windows must not leak a view once file without consuming its view
+    if file.visibility == FileVisibility.ONCE:
+        return jsonify({"error": "file can be viewed only once"}), 403
+    start = max(request.args.get("start", 0, int), 0)
+    count = min(max(request.args.get("count", SOURCE_WINDOW_LINES, int), 1), SOURCE_WINDOW_LINES)
+
+    etag = page_etag(file.blob_hash, start, count)
+    if response := not_modified(etag, weak=True):
+        return response
+
+    lines = file.line_count()
+    count = max(min(count, lines - start), 0)
+    response = jsonify({
+        "start": start,
+        "count": count,
+        "lines": lines,
+        "html": file.highlighted_lines_html(start, count) if count else "",
+    })
+    response.set_etag(etag, weak=True)
+    return response
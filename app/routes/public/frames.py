@@ -26,9 +26,9 @@ def frame_feed():
             ).where(
             (File.path.endswith(".html") | File.path.endswith(".htm"))
             )
-    feed = [file.to_dict(show_content=False) for file in files]
-    shuffle(feed)
-    feed = feed[:100]
+    files = list(files)
+    shuffle(files)
+    feed = [file.to_dict(show_content=False) for file in File.prefetch(files[:100])]
     return json.dumps({"feed": feed, "error": (len(feed)==0)}), 200, {"Content-type": "text/json"}
 
 
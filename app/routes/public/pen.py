@@ -1,7 +1,12 @@
 from flask import render_template, abort, redirect
 
-from app.models import Pen
-from .public import public
+from app.models import Blob, Pen
+from .public import public, send_blob, send_page, blob_not_modified, page_etag, not_modified
+
+
+def pen_page_etag(pen: Pen) -> str:
+    """ETag for rendered html of `pen`"""
+    return page_etag(*pen.blob_dependencies, int(pen.modified.timestamp()))
 
 
 @public.route("/pen/<id>")
@@ -21,16 +26,25 @@ def pen_part(id, part):
     part = part.lower()
     match part:
         case "html":
-            return render_template("pen.html", pen=pen), { "Content-Type": "text/text" }
+            etag = pen_page_etag(pen)
+            if response := not_modified(etag, weak=True):
+                return response
+            response = send_page(etag, "pen.html", pen=pen)
+            response.headers["Content-Type"] = "text/text"
+            return response
         case "head":
-            return pen.head_content, { "Content-Type": "text/text" }
+            blob_hash, mimetype = pen.head_blob_hash, "text/text"
         case "body":
-            return pen.body_content, { "Content-Type": "text/text" }
+            blob_hash, mimetype = pen.body_blob_hash, "text/text"
         case "css":
-            return pen.css_content, { "Content-Type": "text/css" }
+            blob_hash, mimetype = pen.css_blob_hash, "text/css"
         case "js":
-            return pen.js_content, { "Content-Type": "text/javascript" }
-    return redirect(pen.path)
+            blob_hash, mimetype = pen.js_blob_hash, "text/javascript"
+        case _:
+            return redirect(pen.path)
+    if response := blob_not_modified(blob_hash):
+        return response
+    return send_blob(Blob.by_hash(blob_hash), mimetype=mimetype)
 
 
 @public.route("/src/pen/<id>")
@@ -49,4 +63,3 @@ def pen_raw(id):
         abort(404)
     pen.hit()
     return render_template("pen.html", pen=pen), { "Content-Type": "text/text" }
-
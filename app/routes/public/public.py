@@ -1,14 +1,13 @@
 import requests
-from flask import Blueprint, render_template, send_file, session, g, request, abort, redirect
+from flask import Blueprint, render_template, send_file, session, g, request, abort, redirect, make_response
 from pygments.formatters import HtmlFormatter
 
 from hashlib import md5
-from random import randint
 from math import ceil
 
 from app.services.search import search_items_with_timedelta
 from app.models import *
-from app.utils import file_path, pastebin_fetch
+from app.utils import file_path, hash_sha256, pastebin_fetch
 from app.config import *
 
 
@@ -16,6 +15,87 @@ public = Blueprint("public", __name__)
 
 pygments_css = HtmlFormatter().get_style_defs()
 
+IMMUTABLE_MAX_AGE = 365*24*60*60
+
+
+def blob_etags(hash: str) -> list[str]:
+    """ETags `send_blob` may use for blob `hash` under current request's Accept-Encoding"""
+    etags = [hash]
+    for encoding in BlobVariant.encodings():
+        if request.accept_encodings[encoding]:
+            etags.append(hash + "-" + encoding)
+    return etags
+
+
+def page_etag(*parts) -> str:
+    """Weak ETag for rendered page built from `parts`"""
+    return hash_sha256("-".join(str(part) for part in parts))
+
+
+def not_modified(*etags: str, weak: bool = False):
+    """Return 304 response if client already has one of `etags`, else None"""
+    if request.method not in ("GET", "HEAD"):
+        return None
+    for etag in etags:
+        if request.if_none_match.contains_weak(etag):
+            response = make_response("", 304)
+            response.set_etag(etag, weak=weak)
+            return response
+    return None
+
+
+def blob_not_modified(hash: str):
+    """Return 304 response if client already has blob `hash` in some encoding, else None"""
+    response = not_modified(*blob_etags(hash))
+    if response:
+        # same as the 200 carries, or shared caches may hand out another encoding
+        response.vary.add("Accept-Encoding")
+    return response
+
+
+def set_immutable(response):
+    """Mark `response` cacheable forever, for content addressed resources"""
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+def send_page(etag: str, *args, **kwargs):
+    """Render template with weak `etag` attached"""
+    response = make_response(render_template(*args, **kwargs))
+    response.set_etag(etag, weak=True)
+    return response
+
+
+def send_blob(blob: Blob, mimetype: str | None = None, download_name: str | None = None, immutable: bool = False):
+    """Send content of `blob` as response, pre-compressed if client accepts it"""
+    response = None
+    for encoding in BlobVariant.encodings():
+        if not request.accept_encodings[encoding]:
+            continue
+        variant_filepath = blob.get_variant(encoding)
+        if variant_filepath:
+            response = send_file(variant_filepath, mimetype=mimetype, download_name=download_name, etag=blob.hash+"-"+encoding)
+            response.headers["Content-Encoding"] = encoding
+            break
+
+    if not response:
+        filepath, codec = blob.locate()
+        if codec == BlobCodec.NONE:
+            response = send_file(filepath, mimetype=mimetype, download_name=download_name, etag=blob.hash)
+        else:
+            response = send_file(blob.open(), mimetype=mimetype, download_name=download_name, etag=blob.hash)
+
+    if download_name is None:
+        # send_file names it after the stored file, a hash, unlike the content sent before
+        response.headers.pop("Content-Disposition", None)
+    response.vary.add("Accept-Encoding")
+    if immutable:
+        set_immutable(response)
+    return response
+
 
 @public.before_request
 def before_request():
@@ -52,34 +132,22 @@ def home():
         session["filter-file-modes"]=list(map(int, request.form.getlist("file-modes")))
         session["filter-file-order"]=request.form.get("filter-order", "r")
 
-    files = File.select().where(File.as_guest==False)
-    files_count = files.count()
-    if not files_count:
-        return render_template("home.html", files=[])
-
     filter_modes = session.setdefault("filter-file-modes", [FileMode.SOURCE, FileMode.RENDER])
     filter_order = session.setdefault("filter-file-order", "r")
 
-    if len(filter_modes) == 2:
-        pass
-    if len(filter_modes) == 1:
-        files = files.where(File.mode == filter_modes[0])
-    if len(filter_modes) == 0:
-        return render_template("home.html", files=[])
-
-    files_count = files.count()
-    if not files_count:
+    if not filter_modes:
         return render_template("home.html", files=[])
 
     if filter_order == "n":
-        return render_template("home.html", files=files.order_by(File.id.desc()).limit(MAX_FILES_ON_HOME))
-
-    _files = []
-
-    for _ in range(MAX_FILES_ON_HOME):
-        _files.append(files[randint(0, files_count-1)])
+        files = File.select().where(
+                File.as_guest == False
+                ).where(
+                File.mode.in_(filter_modes)
+                ).order_by(File.id.desc()).limit(MAX_FILES_ON_HOME)
+        return render_template("home.html", files=File.prefetch(files))
 
-    return render_template("home.html", files=_files) 
+    files = File.random_sample(MAX_FILES_ON_HOME, False, filter_modes)
+    return render_template("home.html", files=File.prefetch(files))
 
 @public.route("/<username>/")
 def user_files(username):
@@ -102,7 +170,7 @@ def search_page():
     total_results, time_took = search_items_with_timedelta(query)
     total_results_count = total_results.count()
     total_pages = ceil(total_results_count / page_size)
-    results = total_results.paginate(page, page_size)
+    results = SearchResult.prefetch(total_results.paginate(page, page_size))
     g.q = query
     kwargs = {
         "results": results,
@@ -1,7 +1,7 @@
-from flask import render_template, send_file, abort
+from flask import render_template, abort
 
 from app.models import TmpFile, TmpFolder
-from .public import public
+from .public import public, send_blob
 
 
 @public.route("/tmp/")
@@ -14,7 +14,7 @@ def tmp_file(code):
     tf = TmpFile.by_code(code)
     if not tf:
         abort(404)
-    return send_file(tf.filepath, download_name=tf.name)
+    return send_blob(tf.blob, download_name=tf.name)
 
 
 @public.route("/tmp/f/")
@@ -11,6 +11,7 @@ from threading import Thread, Lock
 from typing import Callable, Optional
 
 from app.utils import randstr, file_path
+from app.models import FileType
 from app.config import *
 
 ## Executor Meta Scheema
@@ -235,6 +236,7 @@ class Executor:
     """ Executor """
 
     EXECUTORS = {}
+    SUGGESTIONS = {}
 
     def __new__(cls, name: str):
         name = name.lower().strip()
@@ -264,6 +266,16 @@ class Executor:
 
     @classmethod
     def suggest_executors(cls, filename: str) -> list["Executor"]:
+        # extensions are matched at the end of the name, same for every name of an extension key
+        key = FileType.extension_key(filename)
+        if key is None:
+            return cls.find_executors(filename)
+        if key not in cls.SUGGESTIONS:
+            cls.SUGGESTIONS[key] = cls.find_executors(key)
+        return list(cls.SUGGESTIONS[key])
+
+    @classmethod
+    def find_executors(cls, filename: str) -> list["Executor"]:
         suggestions = []
 
         for name, meta in executors.items():
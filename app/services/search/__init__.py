@@ -1,2 +1,2 @@
-from .index import index_item
+from .index import index_item, index_queued
 from .search import search_items, search_items_with_timedelta
@@ -0,0 +1,74 @@
+import os
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from peewee import SqliteDatabase
+
+from app.models.search import SearchResult, SearchDocument, SearchIndexStatus, SearchResultItemType
+from .index import index_tokens, index_document
+from .search import search_items
+
+
+SEARCH_BACKENDS = ["table", "fts"]
+
+
+def synthetic_corpus(documents: int, words: int = 200, vocabulary: int = 5000, seed: int = 0):
+    """Return (meta, content, views) of `documents` random documents and the vocabulary they use"""
+    random = Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    vocabulary = list({"".join(random.choices(letters, k=random.randint(3, 10))) for _ in range(vocabulary)})
+    # word frequencies of natural text roughly follow zipf's law
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    corpus = []
+    for _ in range(documents):
+        meta = " ".join(random.choices(vocabulary, weights, k=3))
+        content = " ".join(random.choices(vocabulary, weights, k=words))
+        corpus.append((meta, content, random.randint(0, 1000)))
+    return corpus, vocabulary, weights
+
+
+def benchmark(documents: int = 1000, queries: int = 200, seed: int = 0) -> dict[str, dict]:
+    """Index a synthetic corpus with every backend in a scratch database and time searches on it"""
+    corpus, vocabulary, weights = synthetic_corpus(documents, seed=seed)
+    random = Random(seed)
+    queries = [" ".join(random.choices(vocabulary, weights, k=random.randint(1, 3))) for _ in range(queries)]
+    models = [SearchIndexStatus, SearchResult, SearchDocument]
+    tokens = sum(len(meta.split()) + len(content.split()) for meta, content, _ in corpus)
+
+    results = {}
+    for backend in SEARCH_BACKENDS:
+        with TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, "search.db")
+            db = SqliteDatabase(db_path)
+            with db.bind_ctx(models):
+                db.create_tables(models)
+
+                start = perf_counter()
+                with db.atomic():
+                    for i, (meta, content, views) in enumerate(corpus, 1):
+                        if backend == "fts":
+                            index_document(i, SearchResultItemType.FILE, str(i), meta, content, views)
+                        else:
+                            index_tokens(SearchResultItemType.FILE, str(i), meta, content, views)
+                index_time = perf_counter() - start
+
+                # what search page does, count and first page
+                timings = []
+                for query in queries:
+                    start = perf_counter()
+                    found = search_items(query, backend)
+                    found.count()
+                    list(found.paginate(1, 32))
+                    timings.append(perf_counter() - start)
+            db.close()
+            timings.sort()
+            results[backend] = {
+                "index_time": index_time,
+                "docs_per_sec": len(corpus) / index_time,
+                "tokens_per_sec": tokens / index_time,
+                "size": os.path.getsize(db_path),
+                "query_mean": sum(timings) / len(timings),
+                "query_p95": timings[int(len(timings) * 0.95) - 1],
+            }
+    return results
@@ -1,8 +1,21 @@
+import logging
 import math
+import os
+from collections import Counter, deque
+from itertools import chain
+from multiprocessing import get_context
+from typing import Iterable, Iterator
+
+from peewee import chunked
 
 from app.utils.helpers import normalize_string, tokenize_string
-from app.models import File, Pen
-from app.models.search import SearchResult, SearchIndexStatus, SearchResultItemType
+from app.models import File, Pen, FileType
+from app.models.file import text_lexer
+from app.models.search import SearchResult, SearchDocument, SearchIndexQueue, SearchIndexStatus, SearchResultItemType, search_db
+from app.config import SEARCH_BACKEND, SEARCH_INDEX_WORKERS, SEARCH_INDEX_BATCH_SIZE
+
+
+logger = logging.getLogger(__name__)
 
 
 def get_item_type(item: File | Pen) -> int:
@@ -19,7 +32,7 @@ def get_item_id(item: File | Pen) -> str:
         return str(item.id)
 
 
-def should_index(item: File | Pen) -> bool:
+def should_index(item: File | Pen, force: bool = False) -> bool:
     item_type = 0
     item_id = ""
 
@@ -33,13 +46,14 @@ def should_index(item: File | Pen) -> bool:
     if not item_type or not item_id:
         return False
 
-    index_status = SearchIndexStatus.get_status(item)
+    if not force:
+        index_status = SearchIndexStatus.get_status(item)
 
-    views_increased = item.views > index_status.last_index_views * 2
-    item_modified = item.modified.timestamp() > index_status.last_index_time.timestamp()
+        views_increased = item.views > index_status.last_index_views * 2
+        item_modified = item.modified.timestamp() > index_status.last_index_time.timestamp()
 
-    if not (views_increased or item_modified):
-        return False
+        if not (views_increased or item_modified):
+            return False
 
     if isinstance(item, File):
         if item.as_guest:
@@ -55,17 +69,20 @@ def should_index(item: File | Pen) -> bool:
         return True
 
 
-def get_meta(item: File | Pen) -> str:
+def get_raw_meta(item: File | Pen) -> str:
     meta = ""
     if isinstance(item, File):
         meta = str(item.title)
+        lexer = FileType.lexer(item.name)
+        if lexer is not text_lexer:
+            # language of the file, found by searching for it
+            meta += " " + lexer.name
     if isinstance(item, Pen):
         meta = str(item.title)
-    meta = normalize_string(meta)
     return meta
 
 
-def get_content(item: File | Pen) -> str:
+def get_raw_content(item: File | Pen) -> str:
     content = ""
     if isinstance(item, File):
         content = item.blob.get_str()
@@ -76,80 +93,310 @@ def get_content(item: File | Pen) -> str:
             item.css_blob.get_str(),
             item.js_blob.get_str(),
         ])
-    content = normalize_string(content)
     return content
 
 
-def get_views(item: File | Pen) -> int:
-    return int(item.views)
-
+def get_meta(item: File | Pen) -> str:
+    return normalize_string(get_raw_meta(item))
 
-def index_item(item: File | Pen) -> bool:
-    """Index `item` into search index."""
 
-    if not should_index(item):
-        return False
+def get_content(item: File | Pen) -> str:
+    return normalize_string(get_raw_content(item))
 
-    item_id = ""
-    item_type = 0
 
-    if isinstance(item, File):
-        item_type = SearchResultItemType.FILE
-        item_id = str(item.id)
-    if isinstance(item, Pen):
-        item_type = SearchResultItemType.PEN
-        item_id = str(item.id)
-
-    index_status = SearchIndexStatus.get_status(item)
-    if not index_status:
-        return False
+def get_views(item: File | Pen) -> int:
+    return int(item.views)
 
-    if not item_type or not item_id:
-        return False
 
-    meta = get_meta(item)
-    content = get_content(item)
-    views = get_views(item)
+def token_rows(item_type: int, item_id: str, meta: str, content: str, views: int) -> list[tuple]:
+    """Return (token, score, item_type, item_id) rows of an item for SearchResult table"""
 
-    meta_tokens = tokenize_string(meta)
-    content_tokens = tokenize_string(content)
+    meta_tokens = Counter(token for token in tokenize_string(meta) if token)
+    content_tokens = Counter(token for token in tokenize_string(content) if token)
 
-    meta_token_count = len(meta_tokens)
-    content_token_count = len(content_tokens)
+    meta_token_count = meta_tokens.total() or 1
+    content_token_count = content_tokens.total() or 1
 
     meta_weigth = 3.0
     content_weigth = 1.0
     views_weight = 0.1
 
-    tokens = meta_tokens + content_tokens
+    views_score = views_weight * math.log(1 + views)
 
-    # deleting old index before making new
-    SearchResult.delete().where(SearchResult.item_id==item_id).where(SearchResult.item_type==item_type).execute()
+    rows = []
+    for token in meta_tokens | content_tokens:
+        normlised_meta_freq = meta_tokens[token] / meta_token_count
+        normlised_content_freq = content_tokens[token] / content_token_count
 
-    for token in tokens:
-        r = SearchResult.get_or_none(token=token, item_id=item_id, item_type=item_type)
-        if r: continue
+        meta_score = meta_weigth * math.log(1 + normlised_meta_freq)
+        content_score = content_weigth * math.log(1 + normlised_content_freq)
 
-        token_freq_in_meta = meta_tokens.count(token)
-        token_freq_in_content = content_tokens.count(token)
+        rows.append((token, meta_score + content_score + views_score, item_type, item_id))
+    return rows
 
-        normlised_meta_freq = token_freq_in_meta / meta_token_count
-        normlised_content_freq = token_freq_in_content / content_token_count
 
-        meta_score = meta_weigth * math.log(1 + normlised_meta_freq)
-        content_score = content_weigth * math.log(1 + normlised_content_freq)
-        views_score = views_weight * math.log(1 + views)
+def write_tokens(item_type: int, item_id: str, rows: list[tuple]):
+    """Replace token rows of an item in SearchResult table"""
+    fields = [SearchResult.token, SearchResult.score, SearchResult.item_type, SearchResult.item_id]
+    # models may be bound to a scratch database, as by benchmark
+    with SearchResult._meta.database.atomic():
+        # deleting old index before making new
+        SearchResult.delete().where(SearchResult.item_id==item_id).where(SearchResult.item_type==item_type).execute()
+        for batch in chunked(rows, 200):
+            SearchResult.insert_many(batch, fields=fields).execute()
+
+
+def index_tokens(item_type: int, item_id: str, meta: str, content: str, views: int):
+    """Write token rows of an item into SearchResult table"""
+    write_tokens(item_type, item_id, token_rows(item_type, item_id, meta, content, views))
 
-        score = meta_score + content_score + views_score
 
-        SearchResult.create(
-            token = token,
-            score = score,
+def index_document(document_id: int, item_type: int, item_id: str, meta: str, content: str, views: int):
+    """Write full text search document of an item, `document_id` is id of its index status"""
+    views_weight = 0.1
+    with SearchDocument._meta.database.atomic():
+        SearchDocument.delete().where(SearchDocument.rowid==document_id).execute()
+        SearchDocument.insert(
+            rowid = document_id,
             item_type = item_type,
-            item_id = item_id
-        )
+            item_id = item_id,
+            boost = views_weight * math.log(1 + views),
+            title = meta,
+            content = content,
+        ).execute()
+
+
+def read_document(item: File | Pen, backend: str) -> tuple:
+    """Return what preparing an item for `backend` needs, reads its content"""
+    return (backend, get_item_type(item), get_item_id(item), get_raw_meta(item), get_raw_content(item), get_views(item))
 
-    index_status.update_last_index_views(item.views)
-    index_status.update_last_index_time()
+
+def prepare_document(document: tuple) -> tuple:
+    """Normalize and tokenize a read document, pure cpu work run by indexing processes"""
+    backend, item_type, item_id, meta, content, views = document
+    meta = normalize_string(meta)
+    content = normalize_string(content)
+    if backend == "fts":
+        # fts5 tokenizes on insert
+        return backend, item_type, item_id, views, (meta, content)
+    return backend, item_type, item_id, views, token_rows(item_type, item_id, meta, content, views)
+
+
+def write_document(prepared: tuple):
+    """Write a prepared document into search index and record its indexing"""
+    backend, item_type, item_id, views, payload = prepared
+    with search_db.atomic():
+        index_status, _ = SearchIndexStatus.get_or_create(item_type=item_type, item_id=item_id)
+        if backend == "fts":
+            index_document(index_status.id, item_type, item_id, *payload, views)
+        else:
+            write_tokens(item_type, item_id, payload)
+        index_status.mark_indexed(views)
+
+
+PREPARE_POLL_INTERVAL = 1 # seconds between liveness checks of an indexing process
+
+
+class IndexingProcessError(Exception):
+    """ An indexing process died or its pipe broke """
+
+
+def prepare_worker(connection):
+    """Prepare documents received on `connection` and send them back, until it receives None"""
+    while (document := connection.recv()) is not None:
+        connection.send(prepare_document(document))
+
+
+def start_prepare_workers(workers: int) -> list[tuple]:
+    """Spawn `workers` indexing processes, returns their (connection, process)"""
+    # spawned, forking would copy eventlet hub, threads and open database connections.
+    # no executor either, its feeder threads are green under eventlet and a full pipe blocks the hub
+    context = get_context("spawn")
+    pool = []
+    try:
+        for _ in range(workers):
+            connection, child_connection = context.Pipe()
+            process = context.Process(target=prepare_worker, args=(child_connection,), daemon=True)
+            pool.append((connection, process))
+            process.start()
+            child_connection.close()
+    except Exception as e:
+        stop_prepare_workers(pool, force=True)
+        raise IndexingProcessError(f"starting indexing process failed: {e!r}") from e
+    return pool
+
+
+def stop_prepare_workers(pool: list[tuple], force: bool = False):
+    """Stop indexing processes of `pool`, asking idle ones or terminating busy ones if `force`"""
+    for connection, process in pool:
+        if force and process.pid is not None:
+            process.terminate()
+        elif not force:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+        connection.close()
+    for _, process in pool:
+        if process.pid is None:
+            continue
+        process.join(PREPARE_POLL_INTERVAL * 5)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+    pool.clear()
+
+
+def send_document(connection, process, document: tuple):
+    """Send `document` to idle indexing `process`"""
+    if not process.is_alive():
+        raise IndexingProcessError(f"indexing process exited with {process.exitcode}")
+    try:
+        connection.send(document)
+    except OSError as e:
+        raise IndexingProcessError(f"sending to indexing process failed: {e!r}") from e
+
+
+def receive_document(connection, process) -> tuple:
+    """Receive prepared document from busy indexing `process`, without waiting on a dead one"""
+    try:
+        while not connection.poll(PREPARE_POLL_INTERVAL):
+            if not process.is_alive():
+                raise IndexingProcessError(f"indexing process exited with {process.exitcode}")
+        return connection.recv()
+    except (EOFError, OSError) as e:
+        raise IndexingProcessError(f"receiving from indexing process failed: {e!r}") from e
+
+
+def prepare_in_pool(documents: Iterable[tuple], workers: int) -> Iterator[tuple]:
+    """Prepare `documents` in `workers` processes, in order, the rest in this process if one of them fails"""
+    documents = iter(documents)
+    pool, busy = [], deque()
+    waiting = None # taken from `documents`, not sent yet
+    try:
+        pool = start_prepare_workers(workers)
+        idle = list(pool)
+        for document in documents:
+            waiting = document
+            if not idle:
+                connection, process, _ = busy[0]
+                prepared = receive_document(connection, process)
+                busy.popleft()
+                idle.append((connection, process))
+                yield prepared
+            connection, process = idle.pop()
+            busy.append((connection, process, document))
+            waiting = None
+            send_document(connection, process, document)
+        while busy:
+            connection, process, _ = busy[0]
+            prepared = receive_document(connection, process)
+            busy.popleft()
+            yield prepared
+    except IndexingProcessError as e:
+        logger.warning("%s, preparing remaining documents in this process", e)
+        stop_prepare_workers(pool, force=True)
+        in_flight = [document for _, _, document in busy]
+        if waiting is not None:
+            in_flight.append(waiting)
+        busy.clear()
+        yield from map(prepare_document, chain(in_flight, documents))
+    finally:
+        # busy ones may be blocked sending a result nobody receives
+        stop_prepare_workers(pool, force=bool(busy))
+
+
+def index_items(
+        items: Iterable[File | Pen],
+        backend: str = SEARCH_BACKEND,
+        workers: int = SEARCH_INDEX_WORKERS,
+        batch_size: int = SEARCH_INDEX_BATCH_SIZE,
+        progress = None
+    ) -> int:
+    """Index indexable `items`, preparing them in parallel and writing batches from this thread, returns number indexed"""
+    workers = workers or os.cpu_count() or 1
+    documents = (read_document(item, backend) for item in items if should_index(item, force=True))
+    if workers > 1:
+        prepared = prepare_in_pool(documents, workers)
+    else:
+        prepared = map(prepare_document, documents)
+
+    indexed = 0
+    for batch in chunked(prepared, batch_size):
+        with search_db.atomic():
+            for document in batch:
+                write_document(document)
+        indexed += len(batch)
+        if progress:
+            progress(indexed)
+    return indexed
+
+
+def index_item(item: File | Pen, force: bool = False, backend: str = SEARCH_BACKEND) -> bool:
+    """Index `item` into search index."""
+
+    if not should_index(item, force):
+        return False
+
+    write_document(prepare_document(read_document(item, backend)))
     return True
 
+
+def remove_item(item_type: int, item_id: str):
+    """Remove an item from search index"""
+    index_status = SearchIndexStatus.get_or_none(item_type=item_type, item_id=item_id)
+    with search_db.atomic():
+        SearchResult.delete().where(SearchResult.item_id==item_id).where(SearchResult.item_type==item_type).execute()
+        if index_status:
+            SearchDocument.delete().where(SearchDocument.rowid==index_status.id).execute()
+            index_status.delete_instance()
+
+
+def index_queued(limit: int = 100) -> int:
+    """Index a batch of queued items again, or remove them if gone or hidden, returns batch size"""
+    entries = SearchIndexQueue.batch(limit)
+    if not entries:
+        return 0
+    file_ids = [int(entry.item_id) for entry in entries if entry.item_type == SearchResultItemType.FILE]
+    pen_ids = [entry.item_id for entry in entries if entry.item_type == SearchResultItemType.PEN]
+    items = {}
+    if file_ids:
+        items.update({(SearchResultItemType.FILE, str(file.id)): file for file in File.select().where(File.id.in_(file_ids))})
+    if pen_ids:
+        items.update({(SearchResultItemType.PEN, pen.id): pen for pen in Pen.select().where(Pen.id.in_(pen_ids))})
+
+    indexed, failed = [], []
+    for entry in entries:
+        item = items.get((entry.item_type, entry.item_id))
+        try:
+            if item and should_index(item, force=True):
+                index_item(item, force=True)
+            else:
+                remove_item(entry.item_type, entry.item_id)
+        except Exception:
+            # an item failing to index must not block the queue, nor be dropped from it
+            logger.exception("indexing item %s of type %s failed, attempt %s", entry.item_id, entry.item_type, entry.attempts + 1)
+            failed.append(entry)
+        else:
+            indexed.append(entry)
+    SearchIndexQueue.done(indexed)
+    SearchIndexQueue.retry_later(failed)
+    return len(entries)
+
+
+def rebuild_index(
+        backend: str = SEARCH_BACKEND,
+        progress = None,
+        workers: int = SEARCH_INDEX_WORKERS,
+        batch_size: int = SEARCH_INDEX_BATCH_SIZE
+    ) -> int:
+    """Drop and index again every indexable item, returns number of items indexed"""
+    if backend == "fts":
+        SearchDocument.delete().execute()
+    else:
+        SearchResult.delete().execute()
+    items = chain(File.select().iterator(), Pen.select().iterator())
+    indexed = index_items(items, backend, workers, batch_size, progress)
+    if backend == "fts":
+        SearchDocument.optimize()
+    return indexed
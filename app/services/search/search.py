@@ -2,12 +2,35 @@ from typing import Iterable
 from time import time
 
 from app.utils import normalize_string, tokenize_string
-from app.models.search import SearchResult
+from app.models.search import SearchResult, SearchDocument
+from app.config import SEARCH_BACKEND
 
 
-def search_items(query: str) -> Iterable[SearchResult]:
+def fts_query(query: str) -> str:
+    """Translate user `query` into fts5 query, quoted parts match as phrases and words as prefixes"""
+    terms = []
+    # parts between double quotes are at odd positions
+    for i, part in enumerate(query.split('"')):
+        tokens = [token for token in tokenize_string(normalize_string(part)) if token]
+        if not tokens:
+            continue
+        if i % 2:
+            terms.append('"' + " ".join(tokens) + '"')
+        else:
+            terms += ['"' + token + '"*' for token in tokens]
+    # bm25 sums over matched terms, items matching more of them rank higher
+    return " OR ".join(terms)
+
+
+def search_items(query: str, backend: str = SEARCH_BACKEND) -> Iterable[SearchResult | SearchDocument]:
     """Search items based on query from search index."""
 
+    if backend == "fts":
+        match = fts_query(query)
+        if not match:
+            return SearchDocument.select().where(SearchDocument.rowid.in_([]))
+        return SearchDocument.ranked(match)
+
     normlized_query = normalize_string(query)
     query_tokens = list(set(tokenize_string(normlized_query)))
     filter = None
@@ -27,7 +50,7 @@ def search_items(query: str) -> Iterable[SearchResult]:
             ).order_by(SearchResult.score.desc())
     return reasults
 
-def search_items_with_timedelta(query: str) -> tuple[Iterable[SearchResult], float]:
+def search_items_with_timedelta(query: str) -> tuple[Iterable[SearchResult | SearchDocument], float]:
     """Search items based on query from search index with time taken to search"""
     s = time()
     rs = search_items(query)
@@ -1,3 +1,6 @@
+from .cache import *
+from .chunking import *
+from .counters import *
 from .fetch import *
 from .git import *
 from .helpers import *
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    """ Least recently used cache bounded by total size of values """
+
+    def __init__(self, limit: int, max_item_size: int | None = None):
+        self.limit = limit
+        self.max_item_size = limit // 8 if max_item_size is None else max_item_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__items = OrderedDict()
+        self.__lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.__items)
+
+    def __contains__(self, key) -> bool:
+        return key in self.__items
+
+    def get(self, key, default=None):
+        with self.__lock:
+            if key not in self.__items:
+                self.misses += 1
+                return default
+            self.__items.move_to_end(key)
+            self.hits += 1
+            return self.__items[key]
+
+    def set(self, key, value: bytes | str) -> bool:
+        """Store `value` under `key`, returns False if it is too large to be cached"""
+        value_size = len(value)
+        if value_size > self.max_item_size:
+            return False
+        with self.__lock:
+            if key in self.__items:
+                self.size -= len(self.__items.pop(key))
+            self.__items[key] = value
+            self.size += value_size
+            while self.size > self.limit:
+                _, evicted = self.__items.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+        return True
+
+    def clear(self):
+        with self.__lock:
+            self.__items.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            "items": len(self.__items),
+            "size": self.size,
+            "limit": self.limit,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,66 @@
+from hashlib import sha256
+from typing import BinaryIO, Iterator
+
+
+CDC_MIN_SIZE = 16 * 1024
+CDC_AVG_SIZE = 64 * 1024
+CDC_MAX_SIZE = 256 * 1024
+
+# fixed random value per byte, must never change or stored chunks stop matching
+CDC_GEAR = [int.from_bytes(sha256(bytes([i])).digest()[:8], "big") for i in range(256)]
+CDC_HASH_MASK = (1 << 64) - 1
+
+
+def cdc_masks(avg_size: int) -> tuple[int, int]:
+    """ Return FastCDC masks used before and after reaching `avg_size` """
+    # normalized chunking, harder to cut below average, easier above it
+    bits = avg_size.bit_length() - 1
+    mask_small = ((1 << (bits + 2)) - 1) << (64 - bits - 2)
+    mask_large = ((1 << (bits - 2)) - 1) << (64 - bits + 2)
+    return mask_small, mask_large
+
+
+def cdc_cut_point(data: bytes, start: int, end: int, min_size: int, avg_size: int, max_size: int) -> int:
+    """ Return end offset of chunk starting at `start` of `data[:end]` """
+    length = end - start
+    if length <= min_size:
+        return end
+    length = min(length, max_size)
+    normal = min(avg_size, length)
+    mask_small, mask_large = cdc_masks(avg_size)
+
+    fingerprint = 0
+    # no cut can fall within min_size, skip hashing it
+    for i in range(start + min_size, start + normal):
+        fingerprint = ((fingerprint << 1) + CDC_GEAR[data[i]]) & CDC_HASH_MASK
+        if not fingerprint & mask_small:
+            return i + 1
+    for i in range(start + normal, start + length):
+        fingerprint = ((fingerprint << 1) + CDC_GEAR[data[i]]) & CDC_HASH_MASK
+        if not fingerprint & mask_large:
+            return i + 1
+    return start + length
+
+
+def content_defined_chunks(
+        stream: BinaryIO,
+        min_size: int = CDC_MIN_SIZE,
+        avg_size: int = CDC_AVG_SIZE,
+        max_size: int = CDC_MAX_SIZE
+    ) -> Iterator[bytes]:
+    """ Split content of `stream` into FastCDC chunks, boundaries follow content not offsets """
+    buffer = b""
+    start = 0
+    eof = False
+    while True:
+        if not eof and len(buffer) - start < max_size:
+            data = stream.read(max_size * 4)
+            eof = not data
+            buffer = buffer[start:] + data
+            start = 0
+            continue
+        if start >= len(buffer):
+            return
+        end = cdc_cut_point(buffer, start, len(buffer), min_size, avg_size, max_size)
+        yield buffer[start:end]
+        start = end
@@ -0,0 +1,82 @@
+from atexit import register as atexit_register
+from collections import defaultdict
+from threading import Lock
+
+
+class WriteBehindCounter:
+    """ Aggregates increments of an integer column in memory and writes them in batches """
+
+    def __init__(self, model, field):
+        self.model = model
+        self.field = field
+        self.__pending = defaultdict(int)
+        self.__lock = Lock()
+        counters.append(self)
+
+    def __len__(self) -> int:
+        return len(self.__pending)
+
+    def add(self, id: int, amount: int = 1):
+        with self.__lock:
+            self.__pending[id] += amount
+
+    def pending(self, id: int) -> int:
+        """Increments of `id` not yet written"""
+        return self.__pending.get(id, 0)
+
+    def flush(self) -> int:
+        """Write pending increments in one transaction, returns number of rows updated"""
+        with self.__lock:
+            pending, self.__pending = self.__pending, defaultdict(int)
+        if not pending:
+            return 0
+
+        # most rows get the same small increment, one UPDATE per distinct amount
+        by_amount = defaultdict(list)
+        for id, amount in pending.items():
+            by_amount[amount].append(id)
+
+        model, field = self.model, self.field
+        try:
+            with model._meta.database.atomic():
+                for amount, ids in by_amount.items():
+                    for i in range(0, len(ids), 500):
+                        model.update({field: field + amount}).where(
+                            model.id.in_(ids[i:i+500])
+                        ).execute()
+        except Exception:
+            # keep them for the next flush
+            with self.__lock:
+                for id, amount in pending.items():
+                    self.__pending[id] += amount
+            raise
+        return len(pending)
+
+
+class WriteBehindCounted:
+    """ Model mixin, saves of existing rows leave out columns owned by a write behind counter,
+    a save would overwrite increments flushed since the row was read """
+
+    def save(self, force_insert: bool = False, only: list | None = None):
+        if not force_insert and self._pk is not None:
+            counted = [counter.field for counter in counters if isinstance(self, counter.model)]
+            only = [
+                field for field in only or self._meta.sorted_fields
+                if not any(field is counted_field for counted_field in counted)
+            ]
+        return super().save(force_insert, only)
+
+
+counters: list[WriteBehindCounter] = []
+
+
+def flush_counters():
+    """Flush every write behind counter"""
+    for counter in counters:
+        try:
+            counter.flush()
+        except Exception:
+            pass
+
+
+atexit_register(flush_counters)
@@ -1,24 +1,24 @@
-import os
 from time import sleep
 
 from app.config import *
+from .counters import flush_counters
 
 
-def search_indexing_daemon(index_fn, *Items):
-    """Index files for search engine"""
-    sleep(300)
+def search_index_worker(SearchIndexQueue, index_queued):
+    """Indexes files and pens queued by their changes"""
     while True:
-        for Item in Items:
-            for item in Item.select():
-                if index_fn(item):
-                    sleep(0.1)
-        sleep(SEARCH_INDEXING_TIME_DELAY)
+        # pushes of other processes, like cli commands, are picked up on timeout
+        SearchIndexQueue.wait(SEARCH_QUEUE_POLL_INTERVAL)
+        sleep(1) # gather a burst of changes into one batch
+        while index_queued():
+            sleep(0.1)
 
-def search_index_purger(SearchResult):
+def search_index_purger(SearchResult, SearchDocument):
     """Deletes indexes with non-existing items"""
+    index = SearchDocument if SEARCH_BACKEND == "fts" else SearchResult
     sleep(300)
     while True:
-        SearchResult.purge()
+        index.purge()
         sleep(3600)
 
 def process_pool_purger(CodeExecution):
@@ -44,37 +44,70 @@ def tmp_folder_purger(TmpFolder):
                 folder.delete_instance()
         to_be_delete = list(TmpFolder.select().where(TmpFolder.file_codes==""))
 
-def blob_purger(Blob, dependents: list):
-    """Delete unused blobs"""
-    delete_queue = []
+def blob_compressor(Blob):
+    """Compresses stored text blobs"""
+    if not BLOB_COMPRESSION:
+        return
     while True:
-        sleep(300)
-        for blob in Blob:
-            sleep(1)
-            queue_to_delete = True
+        sleep(3600)
+        last_hash = ""
+        while blobs := list(Blob.uncompressed(last_hash)):
+            for blob in blobs:
+                blob.compress()
+                sleep(0.1)
+            last_hash = blobs[-1].hash
 
-            for dependent in dependents:
-                instances = dependent.get_blob_dependents(blob)
-                if instances.count():
-                    queue_to_delete = False
-                    if blob in delete_queue:
-                        delete_queue.remove(blob)
-                    break
+def blob_chunker(Blob):
+    """Splits big stored blobs into deduplicated chunks"""
+    if not BLOB_CHUNKING:
+        return
+    while True:
+        sleep(3600)
+        last_hash = ""
+        while blobs := list(Blob.unchunked(last_hash)):
+            for blob in blobs:
+                blob.chunk()
+                sleep(0.1)
+            last_hash = blobs[-1].hash
 
-            if not queue_to_delete:
-                if blob in delete_queue:
-                    delete_queue.remove(blob)
-                continue
-            
-            if queue_to_delete:
-                if blob not in delete_queue:
-                    delete_queue.append(blob)
-                else:
-                    delete_queue.remove(blob)
-                    filepath = blob.filepath
-                    blob.delete_instance()
-                    try:
-                        os.remove(filepath)
-                    except:
-                        pass
+def blob_variant_maker(Blob):
+    """Makes requested pre-compressed blob variants"""
+    while True:
+        hash, encoding = Blob.next_variant_request()
+        blob = Blob.by_hash(hash)
+        if blob:
+            try:
+                blob.make_variant(encoding)
+            except Exception:
+                pass
+        sleep(0.1)
+
+def highlight_warmer(Blob):
+    """Renders requested highlighted html ahead of the first view"""
+    while True:
+        hash, lexer, linenos = Blob.next_highlight_request()
+        blob = Blob.by_hash(hash)
+        if blob:
+            try:
+                blob.warm_highlight(lexer, linenos)
+            except Exception:
+                pass
+        sleep(0.1)
 
+def highlight_evicter(Blob):
+    """Keeps highlighted html files within disk budget"""
+    while True:
+        sleep(3600)
+        Blob.evict_highlights()
+
+def blob_purger(Blob, dependents: list):
+    """Delete unused blobs"""
+    while True:
+        sleep(3600)
+        Blob.purge(dependents)
+
+def counter_flusher():
+    """Writes buffered view counts"""
+    while True:
+        sleep(COUNTER_FLUSH_INTERVAL)
+        flush_counters()
@@ -8,7 +8,7 @@ from .helpers import randstr, file_path
 def git_clone(user, repo: str, dir: str, mode: int, visibility: int, overwrite=True):
     """ Git Clone a repo with HTTP method to user's dir """
 
-    from ..models import User, File, Blob
+    from ..models import User, File, Blob, file_db
 
     if isinstance(user, str):
         user = User.by_username(user)
@@ -44,31 +44,42 @@ def git_clone(user, repo: str, dir: str, mode: int, visibility: int, overwrite=T
                     continue
                 filterd.append(str(item))
 
+    blobs = []
     for full_file_path in filterd:
         blob = Blob.from_file(full_file_path)
         if not blob:
             continue
         rel_file_path = full_file_path[len(str(repo_path))+1:]
-        file_path_ = dir + rel_file_path
+        blobs.append((dir + rel_file_path, blob))
 
-        file = File.by_path(file_path_)
-        if file:
-            if overwrite:
-                file.content = blob
-                file.save()
-                file.set_visibility(visibility)
-                file.set_mode(mode)
-            continue
+    # one transaction for all files and their directory aggregates
+    files = []
+    with file_db.atomic():
+        for file_path_, blob in blobs:
+            file = File.by_path(file_path_)
+            if file:
+                if overwrite:
+                    file.content = blob
+                    file.save()
+                    file.set_visibility(visibility)
+                    file.set_mode(mode)
+                    files.append(file)
+                continue
+
+            file = File.create(
+                path = file_path_,
+                title = file_path_.split("/")[-1],
+                user_id = user.id,
+                blob_hash = blob.hash,
+            )
 
-        file = File.create(
-            path = file_path_,
-            title = file_path_.split("/")[-1],
-            user_id = user.id,
-            blob_hash = blob.hash,
-        )
+            file.set_mode(mode)
+            file.set_visibility(visibility)
+            files.append(file)
 
-        file.set_mode(mode)
-        file.set_visibility(visibility)
+    # saves inside the transaction skip queueing, rows are visible to the index worker now
+    for file in files:
+        file.queue_for_indexing()
 
     rmtree(repo_path)
     return True